@@ -1,7 +1,7 @@
 """Code for parallel-building a set of targets, if needed."""
 from __future__ import print_function
-import errno, os, stat, signal, sys, tempfile, time
-from . import cycles, env, helpers, jobserver, logs, paths, state
+import errno, hashlib, os, shutil, stat, signal, sys, tempfile, time
+from . import cache, cycles, env, helpers, jobserver, logs, paths, rpc, state
 from .logs import debug2, err, warn, meta
 
 
@@ -18,6 +18,49 @@ def _try_stat(filename):
         else:
             raise
 
+def _checksum(filename):
+    """Return the sha1 of the given file, as if we ran redo-stamp <file."""
+    sh = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while 1:
+            b = f.read(1024*1024)
+            if not b:
+                break
+            sh.update(b)
+    return sh.hexdigest()
+
+def _tmpfile_in(dirname):
+    """Return an fd for a new, nameless file in dirname, or None.
+
+    Unlike a file from mkstemp(), we can give it a name later with
+    _link_fd() instead of copying it.  Only Linux can do this, and only
+    on some filesystems.
+    """
+    if not hasattr(os, 'O_TMPFILE'):
+        return None
+    try:
+        return os.open(dirname or '.', os.O_TMPFILE | os.O_RDWR, 0o666)
+    except OSError:
+        # eg. the dir doesn't exist (yet), or the filesystem can't do it.
+        return None
+
+def _link_fd(fd, name):
+    """Give the file from _tmpfile_in() a name.  Return true on success."""
+    try:
+        procfd = os.open('/proc/self/fd', os.O_RDONLY)
+    except OSError:
+        return False  # /proc isn't mounted
+    try:
+        # Without a dir fd, python calls link() instead of linkat(), which
+        # won't follow the /proc symlink to the actual file.
+        os.link(str(fd), name, src_dir_fd=procfd, follow_symlinks=True)
+    except OSError:
+        # eg. the .do script moved the target dir to another filesystem.
+        return False
+    finally:
+        os.close(procfd)
+    return True
+
 def _has_pep446():
     """Test the python version whether the PEP making file descriptors 
     non-inheritable applies"""
@@ -96,6 +139,12 @@ def start_stdin_log_reader(status, details, pretty, color,
             if color != 1:
                 argv.append('--color' if color >= 2 else '--no-color')
             argv.append('-')
+            # If we have an rpc server, it can run redo-log without
+            # starting python all over again.
+            sys.argv = argv
+            rv = rpc.call('log')
+            if rv is not None:
+                os._exit(rv)
             os.execvp(argv[0], argv)
         except Exception as e:  # pylint: disable=broad-except
             sys.stderr.write('redo-log: exec: %s\n' % e)
@@ -130,6 +179,8 @@ class _BuildJob(object):
 
         # attributes of the running process
         self.outfile = None
+        self.outfile_linkable = False
+        self.job = None
 
     def start(self):
         """Actually start running this job in a subproc, if needed."""
@@ -180,10 +231,17 @@ class _BuildJob(object):
             if not sf.is_override:
                 sf.set_static()
             sf.save()
+            # in case an earlier build of it was interrupted
+            helpers.unlink(state.depsname(sf.id))
             return self._finalize(0)
         sf.zap_deps1()
+        # left over from a .do script that didn't run redo-wait
+        shutil.rmtree(state.jobsdir(sf.id), ignore_errors=True)
         (dodir, dofile, _, basename, ext) = paths.find_do_file(sf)
         if not dofile:
+            # We're not going to build it after all, so zap_deps2() won't
+            # get a chance to clean up after zap_deps1().
+            helpers.unlink(state.depsname(sf.id))
             if os.path.exists(t):
                 sf.set_static()
                 sf.save()
@@ -207,6 +265,11 @@ class _BuildJob(object):
         # dir as the target (which by definition must now exist, if you
         # wanted the target to exist).
         #
+        # On Linux, if the target dir already exists, we can do better:
+        # create a nameless file right there with O_TMPFILE.  If it's still
+        # on the same filesystem as the target dir when the .do script
+        # finishes, linkat() gives it a name without copying anything.
+        #
         # On the other hand, the $3 temp filename can be hardcoded to be in
         # the target directory, even if that directory does not exist.
         # It's not *redo*'s job to create that file.  The .do file will
@@ -215,9 +278,24 @@ class _BuildJob(object):
         tmpbase = os.path.join(dodir, basename + ext)
         self.tmpname = tmpbase + '.redo.tmp'
         helpers.unlink(self.tmpname)
-        ffd, fname = tempfile.mkstemp(prefix='redo.', suffix='.tmp')
+        if env.v.CACHE_DIR:
+            todo = cache.unbuilt_deps(sf)
+            if todo:
+                return self._start_cache_deps(todo, dodir, dofile,
+                                              basename, ext)
+        self._start_do(dodir, dofile, basename, ext)
+
+    def _start_do(self, dodir, dofile, basename, ext):
+        """Run dofile to build our target, unless it's in the cache."""
+        t = self.t
+        if env.v.CACHE_DIR and self._restore_cached():
+            return self._finalize(0)
+        ffd = _tmpfile_in(os.path.dirname(self.tmpname))
+        self.outfile_linkable = ffd is not None
+        if ffd is None:
+            ffd, fname = tempfile.mkstemp(prefix='redo.', suffix='.tmp')
+            os.unlink(fname)
         helpers.close_on_exec(ffd, True)
-        os.unlink(fname)
         self.outfile = os.fdopen(ffd, 'w+b')
         # this will run in the dofile's directory, so use only basenames here
         arg1 = basename + ext  # target name (including extension)
@@ -265,7 +343,132 @@ class _BuildJob(object):
             self._subproc(dodir, basename, ext, argv)
         def call_exited(t, rv):
             self._subproc_exited(t, rv, argv)
-        jobserver.start(t, call_subproc, call_exited)
+        self.job = jobserver.start(t, call_subproc, call_exited)
+        if env.v.PREFETCH:
+            self._start_prefetch()
+
+    def _start_prefetch(self):
+        """Start building the targets we depended on last time.
+
+        Our .do script will probably ask for the same ones again, but it
+        might ask for them one at a time.  If there's a spare job token
+        right now, we use it to run redo-ifchange on all of them at once,
+        while the .do script runs.  By the time the script asks for them,
+        they're up to date, or at least already being built.  They don't
+        count as dependencies unless the script asks for them, so if it
+        doesn't anymore, all we've lost is the time to build them.
+        """
+        todo = [d for mode, d in self.sf.deps()
+                if mode == 'm' and d.is_generated and not d.is_override
+                and not (d.is_checked() or d.is_changed())]
+        if not todo or not jobserver.try_token(self.t):
+            return
+        here = os.getcwd()
+        argv = ['redo-ifchange'] + [
+            state.relpath(os.path.join(env.v.BASE, d.name), here)
+            for d in todo]
+        def subtask():
+            # Not on behalf of any target, so that nothing records them as
+            # dependencies.
+            os.environ['REDO_TARGET'] = ''
+            os.environ['REDO_DEPTH'] = env.v.DEPTH + '  '
+            # If one of them depended on us last time, fail instead of
+            # waiting for our lock forever.
+            cycles.add(self.lock.fid)
+            # python ignores SIGPIPE
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            os.execvp(argv[0], argv)
+            assert 0
+            # returns only if there's an exception
+        def job_exited(t, rv):
+            # Any failures are reported again if the .do script asks for
+            # the same targets.
+            state.flush_stamps()
+            state.flush_paths()
+        jobserver.start(self.t, jobfunc=subtask, donefunc=job_exited)
+
+    def _start_cache_deps(self, todo, dodir, dofile, basename, ext):
+        """Bring the targets in todo up to date, then continue _start_self().
+
+        The cache can only tell whether one of its entries for our target
+        matches once the targets that entry depends on are up to date, so
+        we run redo-ifchange on them first, as our .do script would.  They
+        don't count as our dependencies unless we use that entry, or our
+        .do script asks for them.
+        """
+        here = os.getcwd()
+        argv = ['redo-ifchange'] + [
+            state.relpath(os.path.join(env.v.BASE, name), here)
+            for name in todo]
+        state.commit()
+        def subtask():
+            # Not on behalf of any target, so that nothing records them as
+            # dependencies.
+            os.environ['REDO_TARGET'] = ''
+            os.environ['REDO_DEPTH'] = env.v.DEPTH + '  '
+            # If one of them depends on us, fail instead of waiting for our
+            # lock forever.
+            cycles.add(self.lock.fid)
+            # python ignores SIGPIPE
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            os.execvp(argv[0], argv)
+            assert 0
+            # returns only if there's an exception
+        def job_exited(t, rv):
+            # If some of them failed, the cache just won't match, and our
+            # .do script gets to decide what to do about it.
+            state.flush_stamps()
+            state.flush_paths()
+            self._start_do(dodir, dofile, basename, ext)
+        jobserver.start(self.t, jobfunc=subtask, donefunc=job_exited)
+
+    def _restore_cached(self):
+        """Use a copy of our target from the cache, instead of building it.
+
+        Returns true if we found a copy we can use.
+        """
+        t = self.t
+        sf = self.sf
+        try:
+            hit = cache.fetch(sf, self.tmpname)
+            if hit and os.path.exists(self.tmpname):
+                os.rename(self.tmpname, t)
+            elif hit:
+                helpers.unlink(t)
+        except (IOError, OSError) as e:
+            warn('%s: cache: %s\n' % (_nice(t), e))
+            helpers.unlink(self.tmpname)
+            return False
+        if not hit:
+            return False
+        csum, deps = hit
+        for mode in ('m', 'c'):
+            names = [os.path.join(env.v.BASE, name)
+                     for dmode, name in deps if dmode == mode]
+            sf.add_deps(mode, names)
+            if mode == 'm':
+                # Same as if the .do script had run redo-ifchange on them.
+                for src in state.files_named(names):
+                    if not src.is_generated:
+                        src.set_static()
+                        src.save()
+        state.forget_stamp(sf.name)
+        sf.refresh()
+        sf.is_generated = True
+        sf.is_override = False
+        sf.failed_runid = None
+        if csum and csum == sf.csum:
+            sf.stamp = sf.read_stamp()
+            sf.set_checked()
+        else:
+            sf.csum = csum
+            sf.update_stamp()
+            sf.set_changed()
+        sf.zap_deps2()
+        sf.save()
+        state.commit()
+        meta('cached', state.target_relpath(t))
+        return True
 
     def _start_deps_unlocked(self, dirty):
         """Run jobserver.start to build objects needed to check deps.
@@ -301,6 +504,9 @@ class _BuildJob(object):
             assert 0
             # returns only if there's an exception
         def job_exited(t, rv):
+            # redo-unlocked might have built anything at all.
+            state.flush_stamps()
+            state.flush_paths()
             return self._finalize(rv)
         jobserver.start(self.t, jobfunc=subtask, donefunc=job_exited)
 
@@ -367,7 +573,15 @@ class _BuildJob(object):
         """
         try:
             state.check_sane()
+            # The .do script might have changed any file, not just its
+            # target, so we can't trust any stamps (or directory names)
+            # we saw before.
+            state.flush_stamps()
+            state.flush_paths()
             rv = self._record_new_state(t, rv, argv)
+            job = self.job
+            state.add_stats(self.sf.id, job.start_time, job.wall,
+                            job.utime, job.stime, job.maxrss, rv)
             state.commit()
         finally:
             self._finalize(rv)
@@ -397,34 +611,43 @@ class _BuildJob(object):
             err('...you should write status messages to stderr, not stdout.\n')
             rv = 207
         if rv == 0:
+            # With REDO_AUTO_STAMP, this is the checksum of the new output,
+            # as if the .do script had ended with redo-stamp <$3.
+            csum = None
             # FIXME: race condition here between updating stamp/is_generated
             # and actually renaming the files into place.  There needs to
             # be some kind of two-stage commit, I guess.
             if st1.st_size > 0 and not st2:
-                # script wrote to stdout.  Copy its contents to the tmpfile.
+                # script wrote to stdout.  Make that the tmpfile.
                 helpers.unlink(self.tmpname)
-                try:
-                    newf = open(self.tmpname, 'wb')
-                except IOError as e:
-                    dnt = os.path.dirname(os.path.abspath(t))
-                    if not os.path.exists(dnt):
-                        # This could happen, so report a simple error message
-                        # that gives a hint for how to fix your .do script.
-                        err('%s: target dir %r does not exist!\n' % (t, dnt))
+                if not (self.outfile_linkable and
+                        _link_fd(outfile.fileno(), self.tmpname)):
+                    # No luck; we have to copy it.
+                    try:
+                        newfd = os.open(self.tmpname,
+                                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                        0o666)
+                    except OSError as e:
+                        dnt = os.path.dirname(os.path.abspath(t))
+                        if not os.path.exists(dnt):
+                            # This could happen, so report a simple error
+                            # message that gives a hint for how to fix your
+                            # .do script.
+                            err('%s: target dir %r does not exist!\n'
+                                % (t, dnt))
+                        else:
+                            # This could happen for, eg. a permissions error
+                            # on the target directory.
+                            err('%s: copy stdout: %s\n' % (t, e))
+                        rv = 209
                     else:
-                        # This could happen for, eg. a permissions error on
-                        # the target directory.
-                        err('%s: copy stdout: %s\n' % (t, e))
-                    rv = 209
-                else:
-                    self.outfile.seek(0)
-                    while 1:
-                        b = self.outfile.read(1024*1024)
-                        if not b:
-                            break
-                        newf.write(b)
-                    newf.close()
-                    st2 = _try_stat(self.tmpname)
+                        try:
+                            helpers.copy_fd(outfile.fileno(), newfd, st1.st_size)
+                        finally:
+                            os.close(newfd)
+                st2 = _try_stat(self.tmpname)
+            if st2 and env.v.AUTO_STAMP and stat.S_ISREG(st2.st_mode):
+                csum = _checksum(self.tmpname)
             if st2:
                 # either $3 file was created *or* stdout was written to.
                 # therefore tmpfile now exists.
@@ -439,6 +662,7 @@ class _BuildJob(object):
             else: # no output generated at all; that's ok
                 helpers.unlink(t)
             sf = self.sf
+            state.forget_stamp(sf.name)
             sf.refresh()
             sf.is_generated = True
             sf.is_override = False
@@ -447,8 +671,13 @@ class _BuildJob(object):
                 # update_stamp would call set_changed(); we don't want that,
                 # so only use read_stamp.
                 sf.stamp = sf.read_stamp()
+            elif csum and csum == sf.csum:
+                # Same output as last time, so anything that depends on it
+                # doesn't need to be rebuilt after all.
+                sf.stamp = sf.read_stamp()
+                sf.set_checked()
             else:
-                sf.csum = None
+                sf.csum = csum
                 sf.update_stamp()
                 sf.set_changed()
         # rv might have changed up above
@@ -458,6 +687,11 @@ class _BuildJob(object):
             sf.set_failed()
         sf.zap_deps2()
         sf.save()
+        if rv == 0 and env.v.CACHE_DIR:
+            try:
+                cache.store(sf, t)
+            except (IOError, OSError) as e:
+                warn('%s: cache: %s\n' % (_nice(t), e))
         outfile.close()
         meta('done', '%d %s' % (rv, state.target_relpath(self.t)))
         return rv
@@ -475,6 +709,26 @@ class _BuildJob(object):
             self.lock.unlock()
 
 
+def _longest_first(targets):
+    """Return targets, sorted so that the slowest ones start first.
+
+    When building in parallel, the worst thing that can happen is that
+    the slowest target starts last, and everything else has to wait for
+    it with nothing left to do.  So we guess how long each target will
+    take from how long it took last time.  That time includes building
+    whatever it depends on, which makes it an estimate of the length of
+    its critical path.  Targets we have no record of are assumed to be
+    typical ones, ie. they get the median of the others.  Otherwise, we
+    keep the order we were given.
+    """
+    est = state.durations(targets)
+    if not est:
+        return targets
+    known = sorted(est.values())
+    default = known[len(known) // 2]
+    return sorted(targets, key=lambda t: -est.get(t, default))
+
+
 def run(targets, shouldbuildfunc):
     """Build the given list of targets, if necessary.
 
@@ -492,6 +746,8 @@ def run(targets, shouldbuildfunc):
     if env.v.SHUFFLE:
         import random
         random.shuffle(targets)
+    elif len(targets) > 1 and jobserver.parallel():
+        targets = _longest_first(targets)
 
     locked = []
 
@@ -618,6 +874,9 @@ def run(targets, shouldbuildfunc):
                 # holding a lock, or we could cause deadlocks.
                 jobserver.release_mine()
                 lock.waitlock()
+                # someone else was busy building things while we waited.
+                state.flush_stamps()
+                state.flush_paths()
                 # now t is definitely free, so we get to decide whether
                 # to build it.
                 lock.unlock()
@@ -635,4 +894,6 @@ def run(targets, shouldbuildfunc):
                           donefunc=job_exited).start()
             lock = None
     state.commit()
+    debug2('stamp cache: %d hits, %d misses, %d primed\n'
+           % (state.stamp_hits, state.stamp_misses, state.stamp_primed))
     return retcode[0]
@@ -0,0 +1,302 @@
+"""A cache of built targets that can be shared between checkouts.
+
+If REDO_CACHE_DIR is set, then after building a target, we save a copy of
+it there, along with the content hash of each of its dependencies.  The
+next time anyone (in this checkout or another one) needs to build the same
+target, and all its dependencies still have the same content, we can just
+copy the saved one instead of running its .do script.
+
+The cache dir looks like this:
+
+    <key>/<entry>/info   the stamp checksum and file mode of the target,
+                         and its dependencies, saying which of those
+                         were targets themselves
+    <key>/<entry>/out    the target itself, if it produced a file
+
+where key is a hash of the target's name, relative to the project's base
+dir, and entry is a hash of the info file.  A target can have several
+entries, eg. one for each branch you've built it on.
+
+Only the target is saved, so a .do script that also creates other files
+on the side shouldn't be used with the cache.
+
+Dependencies that are targets can only be compared once they're up to
+date, so before looking for a match, the builder brings them up to date,
+like the target's .do script would have: see unbuilt_deps().
+"""
+import errno, hashlib, os, shutil, stat, tempfile, time
+from . import env, helpers, state
+from .logs import debug2
+
+INFO_VER = 'redo-cache 2'
+
+# If a target has more entries than this, we don't bother checking the
+# older ones.
+MAX_ENTRIES = 20
+
+
+def _hash(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8', 'surrogateescape')
+    return hashlib.sha1(s).hexdigest()
+
+
+def _key(f):
+    return _hash(f.name)
+
+
+def _read_info(path):
+    """Return (csum, mode, deps) from the given info file.
+
+    mode is None if the target produced no file.  deps is a list of
+    (mode, hash, name), where mode is 't' for a dependency that was a
+    target, 'm' for any other file, or 'c' for one that didn't exist.
+    """
+    with open(path) as f:
+        lines = f.read().split('\n')
+    if lines[0] != INFO_VER:
+        raise ValueError('%s: unknown format' % path)
+    csum = lines[1] if lines[1] != '-' else None
+    mode = int(lines[2], 8) if lines[2] != '-' else None
+    deps = [tuple(line.split(' ', 2)) for line in lines[3:] if line]
+    return csum, mode, deps
+
+
+def _is_built(f):
+    """Return true if target f has been brought up to date in this run."""
+    return f.is_checked() or f.is_changed()
+
+
+def _known(name):
+    """Return the File for the given name, or None if redo hasn't seen it.
+
+    Looking at cache entries shouldn't add all their dependencies to the
+    database; most of them are probably from other checkouts.
+    """
+    try:
+        return state.File(name=os.path.join(env.v.BASE, name),
+                          allow_add=False)
+    except KeyError:
+        return None
+
+
+def _is_current(deps):
+    """Return true if each of deps has the same content as it did then."""
+    for mode, h, name in deps:
+        path = os.path.join(env.v.BASE, name)
+        if mode == 'c':
+            if os.path.lexists(path):
+                return False
+            continue
+        if not os.path.lexists(path):
+            return False
+        f = _known(name)
+        if ((mode == 't' or f and f.is_generated and not f.is_override) and
+                not (f and _is_built(f))):
+            # A target that we haven't brought up to date yet: whatever
+            # content it has right now might be about to change.
+            debug2('cache: %s: not built yet\n' % name)
+            return False
+        if state.content_hash(name, state.read_stamp(name)) != h:
+            debug2('cache: %s: changed\n' % name)
+            return False
+    return True
+
+
+def _entries(f):
+    """Yield (entry, csum, mode, deps) for the newest entries for f."""
+    keydir = os.path.join(env.v.CACHE_DIR, _key(f))
+    try:
+        entries = [os.path.join(keydir, name) for name in os.listdir(keydir)
+                   if not name.startswith('tmp.')]
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    entries.sort(key=_mtime, reverse=True)
+    for entry in entries[:MAX_ENTRIES]:
+        try:
+            csum, mode, deps = _read_info(os.path.join(entry, 'info'))
+        except (IOError, OSError, ValueError):
+            continue  # eg. someone just evicted it, or it's an old format
+        yield entry, csum, mode, deps
+
+
+def unbuilt_deps(f):
+    """Return the names of targets we need to build before calling fetch().
+
+    Those are the targets that the cache entries for f depend on, and that
+    haven't been brought up to date in this run yet.  We only consider
+    entries whose other dependencies already match, so that we don't build
+    things for an entry that can't be used anyway.
+    """
+    names = set()
+    for _, _, _, deps in _entries(f):
+        if not _is_current([d for d in deps if d[0] != 't']):
+            continue
+        for mode, _, name in deps:
+            if mode == 't':
+                dep = _known(name)
+                if not (dep and _is_built(dep)):
+                    names.add(name)
+    return sorted(names)
+
+
+def fetch(f, tmpname):
+    """Look for a copy of target f that we can use instead of building it.
+
+    If we find one, and it produced a file, put it in tmpname.
+
+    Returns:
+      (csum, deps) from the cache entry we used, where deps is a list of
+      (mode, name), or None if there's no entry we can use.
+    """
+    for entry, csum, mode, deps in _entries(f):
+        if not _is_current(deps):
+            continue
+        if mode is not None:
+            try:
+                _copy(os.path.join(entry, 'out'), tmpname, mode)
+            except (IOError, OSError):
+                helpers.unlink(tmpname)
+                continue
+        # So that eviction knows it's still useful.
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return csum, [(dmode == 'c' and 'c' or 'm', name)
+                      for dmode, _, name in deps]
+    return None
+
+
+def store(f, t):
+    """Save target f, which was just built into file t, in the cache."""
+    lines = []
+    for mode, dep in f.deps():
+        if dep.name == state.ALWAYS:
+            return  # it's never the same twice
+        if mode == 'c':
+            lines.append('c - %s' % dep.name)
+            continue
+        h = state.content_hash(dep.name, dep.read_stamp())
+        if not h:
+            debug2('cache: %s: not saving; %s is not a file\n'
+                   % (f.name, dep.name))
+            return
+        if dep.is_generated and not dep.is_override:
+            mode = 't'
+        lines.append('%s %s %s' % (mode, h, dep.name))
+    try:
+        st = os.lstat(t)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        st = None
+    if st and not stat.S_ISREG(st.st_mode):
+        return  # a directory or a symlink; we can't handle those
+    info = '\n'.join([INFO_VER,
+                      f.csum or '-',
+                      '%o' % stat.S_IMODE(st.st_mode) if st else '-']
+                     + sorted(lines)) + '\n'
+    keydir = os.path.join(env.v.CACHE_DIR, _key(f))
+    entry = os.path.join(keydir, _hash(info))
+    if os.path.exists(entry):
+        os.utime(entry, None)
+        return
+    try:
+        os.makedirs(keydir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Fill in the entry under a temporary name, so that nobody can see it
+    # before it's complete.
+    tmpdir = tempfile.mkdtemp(prefix='tmp.', dir=keydir)
+    try:
+        if st:
+            _copy(t, os.path.join(tmpdir, 'out'), 0o444)
+        with open(os.path.join(tmpdir, 'info'), 'w') as out:
+            out.write(info)
+        try:
+            os.rename(tmpdir, entry)
+        except OSError as e:
+            # Someone else just saved the same thing.
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+    finally:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _copy(src, dst, mode):
+    """Copy file src to a new file dst with the given mode."""
+    helpers.unlink(dst)
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            helpers.copy_fd(sfd, dfd, os.fstat(sfd).st_size)
+            os.fchmod(dfd, mode)
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+
+def _du(path):
+    total = 0
+    for dirpath, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def evict(max_size=None, max_age=None, dry_run=False):
+    """Remove cache entries that haven't been used for a while.
+
+    First we remove every entry that hasn't been used in max_age seconds,
+    then the least recently used ones until the cache is no bigger than
+    max_size bytes.
+
+    Returns:
+      (number of entries removed, number of bytes removed)
+    """
+    now = time.time()
+    entries = []
+    for key in os.listdir(env.v.CACHE_DIR):
+        keydir = os.path.join(env.v.CACHE_DIR, key)
+        if not os.path.isdir(keydir):
+            continue
+        for name in os.listdir(keydir):
+            path = os.path.join(keydir, name)
+            mtime = _mtime(path)
+            if name.startswith('tmp.') and now - mtime < 24*60*60:
+                continue  # probably being saved right now
+            entries.append((mtime, _du(path), path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    count = nbytes = 0
+    for mtime, size, path in entries:
+        if ((max_age is None or now - mtime <= max_age) and
+                (max_size is None or total <= max_size)):
+            break
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass  # there are other entries in it
+        total -= size
+        count += 1
+        nbytes += size
+    return count, nbytes
@@ -0,0 +1,223 @@
+"""redo-gc: forget files that no longer matter, and shrink .redo."""
+from __future__ import print_function
+import errno, os, re, shutil, sqlite3, sys
+from . import cache, env, logs, options, paths, state
+from .logs import warn
+
+optspec = """
+redo-gc [options...]
+--
+n,dry-run     show what would be removed, but don't remove anything
+v,verbose     print the name of each file forgotten
+
+ cache options:
+cache-dir=    the cache to clean up (default: $REDO_CACHE_DIR)
+cache-size=   remove old entries until the cache is smaller than this (eg. 5G)
+cache-age=    remove entries that haven't been used for this many days
+"""
+
+# the files (and jobs dirs) in .redo that belong to a particular File id
+_fid_file_re = re.compile(r'^(log|deps|jobs)\.(\d+)$')
+
+
+def _has_do_file(f):
+    for dodir, dofile, _, _, _ in paths.possible_do_files(f.name):
+        if os.path.exists(os.path.join(dodir, dofile)):
+            return True
+    return False
+
+
+def _is_root(f):
+    """Return true if f is worth remembering, whether or not anyone uses it."""
+    if f.name == state.ALWAYS:
+        return True
+    if f.read_stamp() != state.STAMP_MISSING:
+        return True  # still exists
+    # A target that has never produced a file (eg. all or test) never
+    # exists, but we still want its log, as long as we can build it.
+    return (f.is_generated and f.stamp == state.STAMP_MISSING and
+            _has_do_file(f))
+
+
+def _declared_ids(redodir, names):
+    """Return the File ids listed in any of the given deps.* files.
+
+    Those are the dependencies of targets being built right now, which
+    might not be in the database yet.
+    """
+    ids = set()
+    for name in names:
+        if not name.startswith('deps.'):
+            continue
+        try:
+            with open(os.path.join(redodir, name)) as f:
+                ids.update(int(line) for line in f if line.strip().isdigit())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return ids
+
+
+_units = {'k': 1000, 'm': 1000**2, 'g': 1000**3, 't': 1000**4}
+
+
+def _parse_size(s):
+    """Return the number of bytes in s, which might be like '10G'."""
+    s = s.strip()
+    mult = _units.get(s[-1:].lower(), 1)
+    if mult != 1:
+        s = s[:-1]
+    return int(float(s) * mult)
+
+
+def _du(path):
+    """Return the number of bytes in path, or in the files in it."""
+    if not os.path.isdir(path):
+        return os.stat(path).st_size
+    n = 0
+    for name in os.listdir(path):
+        try:
+            n += os.lstat(os.path.join(path, name)).st_size
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return n
+
+
+def _size(n):
+    for unit in ('bytes', 'kB', 'MB'):
+        if n < 10000:
+            return '%d %s' % (n, unit)
+        n //= 1000
+    return '%d GB' % n
+
+
+def main():
+    o = options.Options(optspec)
+    (opt, _, extra) = o.parse(sys.argv[1:])
+    if extra:
+        o.fatal('no arguments expected.')
+    max_size = max_age = None
+    try:
+        if opt.cache_size is not None:
+            max_size = _parse_size(str(opt.cache_size))
+        if opt.cache_age is not None:
+            max_age = float(opt.cache_age) * 24*60*60
+    except ValueError as e:
+        o.fatal(str(e))
+    if opt.cache_dir:
+        os.environ['REDO_CACHE_DIR'] = os.path.abspath(opt.cache_dir)
+    if ((max_size is not None or max_age is not None) and
+            not os.environ.get('REDO_CACHE_DIR')):
+        o.fatal('--cache-size and --cache-age need --cache-dir.')
+
+    state.init([])
+    logs.setup(
+        tty=sys.stderr, parent_logs=env.v.LOG,
+        pretty=env.v.PRETTY, color=env.v.COLOR)
+    redodir = os.path.join(env.v.BASE, '.redo')
+
+    # This is our first write, so from here until we commit, sqlite won't
+    # let any other redo change the database.  That way, nobody can add
+    # a dependency on a file after we've decided to forget it.
+    runids = state.compact_runids()
+
+    files = list(state.files())
+    state.prime_stamps(files, threads=env.v.STAT_THREADS)
+    names = os.listdir(redodir)
+
+    # Mark everything reachable from a file we want to keep, and sweep
+    # away the rest.  Anything that's locked is being built right now, so
+    # we keep it too, along with whatever it has declared so far.
+    locks = {}
+    live = set()
+    for f in files:
+        if _is_root(f):
+            live.add(f.id)
+        else:
+            lock = state.Lock(f.id)
+            if lock.trylock():
+                locks[f.id] = lock
+            else:
+                live.add(f.id)
+    live.update(_declared_ids(redodir, names))
+    children = {}
+    for target, source in state.dep_ids():
+        children.setdefault(target, []).append(source)
+    todo = list(live)
+    while todo:
+        for source in children.get(todo.pop(), []):
+            if source not in live:
+                live.add(source)
+                todo.append(source)
+    dead = [f for f in files if f.id not in live]
+
+    for f in dead:
+        if opt.verbose or opt.dry_run:
+            print(f.nicename())
+    deps = state.forget_files([f.id for f in dead])
+    deps += state.forget_dangling_deps()
+    hashes = state.forget_hashes()
+
+    # Logs (and dependency lists) of files we don't know about anymore.
+    known = set(f.id for f in files) - set(f.id for f in dead)
+    nbytes = 0
+    for name in names:
+        g = _fid_file_re.match(name)
+        if not g:
+            continue
+        fid = int(g.group(2))
+        if g.group(1) == 'jobs' and fid in known:
+            # Left over from redo-ifchange --start in a .do script that
+            # didn't run redo-wait.  Nobody will wait for those jobs
+            # anymore, unless its target is being built right now.
+            if fid not in locks:
+                lock = state.Lock(fid)
+                if not lock.trylock():
+                    continue
+                locks[fid] = lock
+        elif fid in known:
+            continue
+        path = os.path.join(redodir, name)
+        try:
+            nbytes += _du(path)
+            if not opt.dry_run:
+                if g.group(1) == 'jobs':
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    if opt.dry_run:
+        state.rollback()
+        before = after = None
+    else:
+        try:
+            before, after = state.vacuum()
+        except sqlite3.OperationalError as e:
+            # eg. someone else is reading the database right now.
+            warn('not compacting database: %s\n' % e)
+            state.commit()
+            before = after = None
+    del locks
+
+    verb = 'would remove' if opt.dry_run else 'removed'
+    sys.stderr.write('redo-gc: %s %d files, %d dependencies, %d hashes and '
+                     '%d old run ids\n'
+                     % (verb, len(dead), deps, hashes, runids))
+    sys.stderr.write('redo-gc: %s %s of old logs\n' % (verb, _size(nbytes)))
+    if before is not None:
+        sys.stderr.write('redo-gc: database: %s -> %s\n'
+                         % (_size(before), _size(after)))
+
+    if max_size is not None or max_age is not None:
+        count, nbytes = cache.evict(max_size=max_size, max_age=max_age,
+                                    dry_run=opt.dry_run)
+        sys.stderr.write('redo-gc: %s %d cache entries (%s)\n'
+                         % (verb, count, _size(nbytes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,46 @@
 """redo-ifchange: build the given targets if they have changed."""
-import os, sys, traceback
-from . import env, builder, deps, helpers, jobserver, logs, state
+import errno, fcntl, os, sys, tempfile, traceback
+from . import env, builder, deps, helpers, jobserver, logs, rpc, state
 from .logs import debug2, err
 
 
-def should_build(t):
-    f = state.File(name=t)
-    if f.is_failed():
-        raise helpers.ImmediateReturn(32)
-    dirty = deps.isdirty(f, depth='', max_changed=env.v.RUNID,
-                         already_checked=[])
-    return f.is_generated, dirty == [f] and deps.DIRTY or dirty
+def _background(f):
+    """Fork, so that the rest of the build happens in the background.
+
+    Returns:
+      The fd of our file in state.jobsdir(), in the child process.  The
+      parent process exits right away.
+    """
+    jobsdir = state.jobsdir(f.id)
+    try:
+        os.mkdir(jobsdir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, _ = tempfile.mkstemp(dir=jobsdir)
+    helpers.close_on_exec(fd, True)
+    # flock() locks belong to the open file, not the process, so the child
+    # inherits this one, and holds it until it exits.
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    state.commit()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork():
+        # Don't touch the database or the jobserver: they're the child's
+        # now.
+        os._exit(0)
+    return fd
 
 
 def main():
     rv = 202
     try:
         targets = sys.argv[1:]
+        start = targets[:1] == ['--start']
+        if start:
+            targets = targets[1:]
+        if not os.environ.get('REDO'):
+            rpc.start_server()
         state.init(targets)
         if env.is_toplevel and not targets:
             targets = ['all']
@@ -38,24 +62,36 @@ def main():
         else:
             f = me = None
             debug2('redo-ifchange: not adding depends.\n')
+        if start and not f:
+            err('--start only works inside a .do script.\n')
+            sys.exit(1)
         jobserver.setup(0)
+        jobfd = None
         try:
             if f:
-                for t in targets:
-                    f.add_dep('m', t)
+                f.add_deps('m', targets)
                 f.save()
                 state.commit()
-            rv = builder.run(targets, should_build)
+            if start:
+                jobfd = _background(f)
+                jobserver.borrow_token('background')
+            rv = builder.run(targets, deps.should_build)
         finally:
             try:
                 state.rollback()
             finally:
                 try:
-                    jobserver.force_return_tokens()
+                    if jobfd is None:
+                        jobserver.force_return_tokens()
+                    else:
+                        jobserver.return_borrowed()
                 except Exception as e:  # pylint: disable=broad-except
                     traceback.print_exc(100, sys.stderr)
                     err('unexpected error: %r\n' % e)
                     rv = 1
+                if jobfd is not None:
+                    # for redo-wait
+                    os.write(jobfd, ('%d\n' % rv).encode('ascii'))
     except (KeyboardInterrupt, helpers.ImmediateReturn):
         if env.is_toplevel:
             builder.await_log_reader()
@@ -30,6 +30,9 @@ total_lines = 0
 status = None
 start_time = time.time()
 
+# See _suspend().
+MAX_OPEN_LOGS = 100
+
 
 # regexp for matching "redo" lines in the log, which we use for recursion.
 # format:
@@ -54,7 +57,10 @@ def is_locked(fid):
 
 
 def _fix_depth():
-    env.v.DEPTH = len(depth) * '  '
+    # Only PrettyLog indents its output.  Don't build ever-longer strings
+    # for each level of a very deep tree if nobody will see them.
+    if opt.pretty:
+        env.v.DEPTH = len(depth) * '  '
 
 
 def _rel(top, mydir, path):
@@ -65,12 +71,42 @@ def catlog(t):
     """Copy the given log content to our current log output device.
 
     Note: this function's behaviour depends on global command-line options.
+
+    With --recursive, the logs of dependencies are included inline, in the
+    order they appear.  Rather than recursing (and running out of Python
+    stack on very long chains of dependencies), we keep a stack of
+    _catlog() generators, each of which yields the name of a log it wants
+    to include, and is then sent the number of lines that produced.
+    """
+    stack = []
+    sub = t
+    got = None
+    while 1:
+        if sub is not None:
+            result = [0]
+            stack.append((_catlog(sub, result), result))
+            got = None
+        gen, result = stack[-1]
+        try:
+            sub = gen.send(got)
+        except StopIteration:
+            stack.pop()
+            sub = None
+            got = result[0]
+            if not stack:
+                return got
+
+
+def _catlog(t, result):
+    """Generator doing the work for catlog(); see there for details.
+
+    Stores the number of lines written in result[0] when done.
     """
     global total_lines, status
     lines_written = 0
     interrupted = 0
     if t in already:
-        return 0
+        return
     if t != '-':
         depth.append(t)
     _fix_depth()
@@ -95,6 +131,7 @@ def catlog(t):
         loglock = state.Lock(fid + state.LOG_LOCK_MAGIC)
         loglock.waitlock(shared=True)
         f = None
+    resume_at = None
     delay = 0.01
     was_locked = is_locked(fid)
     line_head = ''
@@ -109,6 +146,18 @@ def catlog(t):
                     pass
                 else:
                     raise
+            else:
+                if resume_at is not None:
+                    pos, ino = resume_at
+                    resume_at = None
+                    if os.fstat(f.fileno()).st_ino != ino:
+                        # The target was rebuilt while we were showing
+                        # another log, so the instance we were reading is
+                        # gone, and the new one starts somewhere else.
+                        f.close()
+                        f = None
+                        break
+                    f.seek(pos)
         if f:
             # Note: normally includes trailing \n.
             # In 'follow' mode, might get a line with no trailing \n
@@ -181,7 +230,10 @@ def catlog(t):
                     if opt.recursive:
                         if loglock:
                             loglock.unlock()
-                        got = catlog(os.path.join(mydir, text))
+                        resume_at = _suspend(f, logname)
+                        if resume_at is not None:
+                            f = None
+                        got = yield os.path.join(mydir, text)
                         interrupted += got
                         lines_written += got
                         if loglock:
@@ -201,7 +253,10 @@ def catlog(t):
                     assert text
                     if loglock:
                         loglock.unlock()
-                    got = catlog(os.path.join(mydir, text))
+                    resume_at = _suspend(f, logname)
+                    if resume_at is not None:
+                        f = None
+                    got = yield os.path.join(mydir, text)
                     interrupted += got
                     lines_written += got
                     if loglock:
@@ -237,7 +292,24 @@ def catlog(t):
         assert depth[-1] == t
         depth.pop(-1)
     _fix_depth()
-    return lines_written
+    result[0] = lines_written
+
+
+def _suspend(f, logname):
+    """Close log file f while we include another log, if we have to.
+
+    Each level of --recursive keeps its log open, but a very long chain of
+    dependencies would run out of file descriptors that way, so beyond
+    MAX_OPEN_LOGS levels we close it and reopen it by name afterwards.
+    Returns the (position, inode) to go back to after reopening, or None
+    if f is still open.
+    """
+    if not f or not logname or len(depth) < MAX_OPEN_LOGS:
+        return None
+    pos = f.tell()
+    ino = os.fstat(f.fileno()).st_ino
+    f.close()
+    return pos, ino
 
 
 def main():
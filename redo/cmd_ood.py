@@ -4,6 +4,7 @@ import sys, os
 from . import deps, env, logs, state
 
 cache = {}
+memo = {}
 
 
 def is_checked(f):
@@ -28,7 +29,13 @@ def main():
         tty=sys.stderr, parent_logs=env.v.LOG,
         pretty=env.v.PRETTY, color=env.v.COLOR)
     cwd = os.getcwd()
-    for f in state.files():
+    files = list(state.files())
+    # We're going to look at every target anyway, and nothing gets built
+    # while we do, so load the whole graph once and share what we learn
+    # about each target between all the isdirty() calls.
+    graph = state.deps_closure(files, everything=True)
+    state.prime_stamps(files, threads=env.v.STAT_THREADS)
+    for f in files:
         if f.is_target():
             if deps.isdirty(f,
                             depth='',
@@ -36,7 +43,9 @@ def main():
                             already_checked=[],
                             is_checked=is_checked,
                             set_checked=set_checked,
-                            log_override=log_override):
+                            log_override=log_override,
+                            memo=memo,
+                            graph=graph):
                 print(state.relpath(os.path.join(env.v.BASE, f.name), cwd))
 
 
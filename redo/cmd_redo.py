@@ -16,7 +16,8 @@
 #
 from __future__ import print_function
 import sys, os, traceback
-from . import builder, env, helpers, jobserver, logs, options, state
+from . import builder, deps, env, helpers, jobserver, logs, options, rpc
+from . import state, watch
 from .atoi import atoi
 from .logs import warn, err
 
@@ -29,6 +30,13 @@ v,verbose  print commands as they are read from .do files (variables intact)
 x,xtrace   print commands as they are executed (variables expanded)
 k,keep-going  keep going as long as possible even if some targets fail
 shuffle    randomize the build order to find dependency bugs
+stat-threads=  check this many files at once (for network filesystems)
+hash-sources   ignore source files whose content hasn't changed
+auto-stamp     don't rebuild dependents of targets whose output didn't change
+cache-dir=     share built targets with other checkouts through this dir
+prefetch       start building each target's last known deps while its .do runs
+rpc            run redo-ifchange from .do scripts in a server process
+watch      rebuild the targets again whenever their sources change
 version    print the current version and exit
 
  redo-log options:
@@ -47,6 +55,8 @@ def main():
 
     targets = extra
 
+    if opt.watch and os.environ.get('REDO'):
+        o.fatal('--watch only works when run from the command line.')
     if opt.version:
         from . import version
         print(version.TAG)
@@ -61,6 +71,18 @@ def main():
         os.environ['REDO_KEEP_GOING'] = '1'
     if opt.shuffle:
         os.environ['REDO_SHUFFLE'] = '1'
+    if opt.stat_threads:
+        os.environ['REDO_STAT_THREADS'] = str(atoi(opt.stat_threads))
+    if opt.hash_sources:
+        os.environ['REDO_HASH_SOURCES'] = '1'
+    if opt.auto_stamp:
+        os.environ['REDO_AUTO_STAMP'] = '1'
+    if opt.cache_dir:
+        os.environ['REDO_CACHE_DIR'] = os.path.abspath(opt.cache_dir)
+    if opt.prefetch:
+        os.environ['REDO_PREFETCH'] = '1'
+    if opt.rpc:
+        os.environ['REDO_RPC'] = '1'
     if opt.debug_locks:
         os.environ['REDO_DEBUG_LOCKS'] = '1'
     if opt.debug_pids:
@@ -72,8 +94,22 @@ def main():
     _set_defint('REDO_PRETTY', opt.pretty)
     _set_defint('REDO_COLOR', opt.color)
 
+    if not os.environ.get('REDO'):
+        # Before we open the database, so the server doesn't inherit it.
+        rpc.start_server()
+
     try:
+        shouldbuild = lambda t: (True, True)
+        if opt.watch:
+            # Returns in a new child process for each build.
+            targets, first = watch.start(targets or ['all'])
+            if not first:
+                # Only rebuild what the changes affected, like
+                # redo-ifchange would.
+                shouldbuild = deps.should_build
         state.init(targets)
+        if opt.watch and not first:
+            watch.skip_unchanged(targets)
         if env.is_toplevel and not targets:
             targets = ['all']
         j = atoi(opt.jobs)
@@ -107,11 +143,14 @@ def main():
         jobserver.setup(j)
         try:
             assert state.is_flushed()
-            retcode = builder.run(targets, lambda t: (True, True))
+            retcode = builder.run(targets, shouldbuild)
             assert state.is_flushed()
         finally:
             try:
                 state.rollback()
+                # Even if the build failed, --watch needs to know what to
+                # watch.
+                watch.report(targets)
             finally:
                 try:
                     jobserver.force_return_tokens()
@@ -15,7 +15,9 @@ def main():
         pretty=env.v.PRETTY, color=env.v.COLOR)
 
     cwd = os.getcwd()
-    for f in state.files():
+    files = list(state.files())
+    state.prime_stamps(files, threads=env.v.STAT_THREADS)
+    for f in files:
         if f.is_source():
             print(state.relpath(os.path.join(env.v.BASE, f.name), cwd))
 
@@ -1,15 +1,56 @@
 """redo-stamp: tell redo to use a checksum when considering this target."""
-import sys, os
-from . import env, logs, state
+import hashlib, mmap, os, stat, sys
+from . import env, logs, options, state
 from .logs import debug2
 
+optspec = """
+redo-stamp [options...] [files...]
+--
+hash=    checksum algorithm to use, eg. blake2b (default: sha1)
+"""
+
+BUFSIZE = 1024*1024
+
+
+def _update(sh, fd):
+    """Add the rest of the data in fd to the checksum sh."""
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode):
+        # We might not be at the start (eg. the .do script has already
+        # read part of its stdin), so only use what comes after here.
+        pos = os.lseek(fd, 0, os.SEEK_CUR)
+        if st.st_size <= pos:
+            return  # empty files can't be mmapped, and there's nothing to do
+        m = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ)
+        try:
+            try:
+                # Slicing a memoryview doesn't copy the data, but python 2
+                # can't make one of an mmap, so there we slice m itself.
+                buf = memoryview(m)
+            except TypeError:
+                buf = m
+            try:
+                for i in range(pos, st.st_size, BUFSIZE):
+                    sh.update(buf[i:i+BUFSIZE])
+            finally:
+                if buf is not m:
+                    buf.release()  # or m.close() would fail
+        finally:
+            m.close()
+        os.lseek(fd, st.st_size, os.SEEK_SET)
+    else:
+        while 1:
+            b = os.read(fd, BUFSIZE)
+            if not b:
+                break
+            sh.update(b)
+
 
 def main():
-    if len(sys.argv) > 1:
-        sys.stderr.write('%s: no arguments expected.\n' % sys.argv[0])
-        sys.exit(1)
+    o = options.Options(optspec)
+    (opt, _, files) = o.parse(sys.argv[1:])
 
-    if os.isatty(0):
+    if not files and os.isatty(0):
         sys.stderr.write('%s: you must provide the data to stamp on stdin\n'
                          % sys.argv[0])
         sys.exit(1)
@@ -19,25 +60,36 @@ def main():
         tty=sys.stderr, parent_logs=env.v.LOG,
         pretty=env.v.PRETTY, color=env.v.COLOR)
 
-    # hashlib is only available in python 2.5 or higher, but the 'sha'
-    # module produces a DeprecationWarning in python 2.6 or higher.  We want
-    # to support python 2.4 and above without any stupid warnings, so let's
-    # try using hashlib first, and downgrade if it fails.
+    algo = opt.hash or 'sha1'
     try:
-        import hashlib
-    except ImportError:
-        import sha
-        sh = sha.sha()
-    else:
-        sh = hashlib.sha1()
+        sh = hashlib.new(algo)
+    except ValueError:
+        o.fatal('unknown hash algorithm %r' % algo)
+    if not sh.digest_size:
+        o.fatal('hash algorithm %r has no fixed size' % algo)
 
-    while 1:
-        b = os.read(0, 4096)
-        sh.update(b)
-        if not b:
-            break
+    if files:
+        # The same as 'cat files... | redo-stamp', but without the copying.
+        for name in files:
+            try:
+                fd = os.open(name, os.O_RDONLY)
+            except OSError as e:
+                sys.stderr.write('%s: %s: %s\n'
+                                 % (sys.argv[0], name, e.strerror))
+                sys.exit(1)
+            try:
+                _update(sh, fd)
+            finally:
+                os.close(fd)
+    else:
+        _update(sh, 0)
 
     csum = sh.hexdigest()
+    if algo != 'sha1':
+        # sha1 checksums have no prefix, so that they still match the ones
+        # from older versions of redo.  The others need one, so that
+        # switching algorithms counts as a change.
+        csum = '%s:%s' % (algo, csum)
 
     if not env.v.TARGET:
         sys.exit(0)
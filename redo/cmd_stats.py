@@ -0,0 +1,241 @@
+"""redo-stats: report which targets took the longest to build."""
+from __future__ import print_function
+import json, os, sys
+from . import env, logs, options, state
+
+optspec = """
+redo-stats [options...] [targets...]
+--
+n,top=     show this many of the slowest targets [10]
+runs=      show how long each took in this many recent runs [5]
+json       print the report in JSON format
+"""
+
+
+# CPU times are only accurate to a clock tick or so.
+CPU_SLOP = 0.05
+
+
+class _Build(object):
+    """One build of one target, as recorded by state.add_stats()."""
+
+    __slots__ = ['runid', 'fid', 'name', 'start', 'wall', 'cpu', 'maxrss',
+                 'rv', 'self_wall', 'self_cpu', 'children']
+
+    def __init__(self, row):
+        (self.runid, self.fid, self.name, self.start, self.wall,
+         utime, stime, self.maxrss, self.rv) = row
+        self.cpu = utime + stime
+        self.children = []
+
+    def end(self):
+        return self.start + self.wall
+
+
+def _busy(builds):
+    """Return the number of seconds during which any of builds was running."""
+    total = 0.0
+    start = end = None
+    for b in sorted(builds, key=lambda b: b.start):
+        if end is None or b.start > end:
+            if end is not None:
+                total += end - start
+            start, end = b.start, b.end()
+        else:
+            end = max(end, b.end())
+    if end is not None:
+        total += end - start
+    return total
+
+
+def _attribute(builds, deps):
+    """Work out how much time each build spent in its own .do script.
+
+    The recorded times of a .do script include building the targets it
+    depends on.  We don't know which .do script built which target, so we
+    guess: of the targets that depend on it and were running the whole
+    time it was, the one that started last.  Then we subtract its
+    children's times from each build.
+
+    If a build used less CPU time than its children, its recorded time
+    can't have included theirs (eg. because of redo --rpc), so we don't
+    know its own CPU time, and set self_cpu to None.
+    """
+    by_fid = dict((b.fid, b) for b in builds)
+    parents = {}
+    for target, source in deps:
+        if target in by_fid and source in by_fid:
+            parents.setdefault(source, []).append(by_fid[target])
+    for b in builds:
+        inside = [p for p in parents.get(b.fid, [])
+                  if p.start <= b.start and b.end() <= p.end() + 0.001]
+        if inside:
+            max(inside, key=lambda p: p.start).children.append(b)
+    for b in builds:
+        b.self_wall = max(0.0, b.wall - _busy(b.children))
+        b.self_cpu = b.cpu - sum(c.cpu for c in b.children)
+        if b.self_cpu < -CPU_SLOP:
+            b.self_cpu = None
+        else:
+            b.self_cpu = max(0.0, b.self_cpu)
+
+
+def _ms(secs):
+    if secs is None:
+        return None
+    return round(secs, 3)
+
+
+def _dur(secs):
+    if secs is None:
+        return '-'
+    if secs < 60:
+        return '%.1fs' % secs
+    return '%dm%02ds' % (secs // 60, secs % 60)
+
+
+def _mem(kbytes):
+    return '%d MB' % (kbytes // 1024)
+
+
+def _report(runids, builds, names, top):
+    """Return the report as a dict, ready to be printed or turned to JSON."""
+    last = [b for b in builds if b.runid == runids[-1]]
+    start = min(b.start for b in last)
+    wall = max(b.end() for b in last) - start
+    cpu = sum(b.self_cpu or 0.0 for b in last)
+    busy = sum(b.self_wall for b in last)
+    run = dict(runid=runids[-1],
+               targets=len(last),
+               failed=len([b for b in last if b.rv]),
+               wall=_ms(wall),
+               cpu=_ms(cpu),
+               # the average number of .do scripts running at once...
+               parallelism=round(wall and busy / wall or 0.0, 2),
+               # ...and of CPUs they kept busy.
+               cpu_usage=round(wall and cpu / wall or 0.0, 2),
+               maxrss=max(b.maxrss for b in last),
+               unknown_cpu=len([b for b in last if b.self_cpu is None]))
+
+    wanted = last
+    if names:
+        wanted = [b for b in last if b.name in names]
+    slowest = sorted(wanted, key=lambda b: b.self_wall, reverse=True)[:top]
+
+    dirs = {}
+    for b in last:
+        d = dirs.setdefault(os.path.dirname(b.name) or '.',
+                            dict(targets=0, self_wall=0.0, self_cpu=0.0))
+        d['targets'] += 1
+        d['self_wall'] = _ms(d['self_wall'] + b.self_wall)
+        d['self_cpu'] = _ms(d['self_cpu'] + (b.self_cpu or 0.0))
+
+    history = {}
+    for b in builds:
+        history[(b.fid, b.runid)] = _ms(b.self_wall)
+
+    return dict(
+        run=run,
+        slowest=[dict(name=b.name, self_wall=_ms(b.self_wall),
+                      wall=_ms(b.wall), self_cpu=_ms(b.self_cpu),
+                      cpu=_ms(b.cpu), maxrss=b.maxrss, rv=b.rv,
+                      trend=[history.get((b.fid, runid))
+                             for runid in runids])
+                 for b in slowest],
+        directories=[dict(name=name, **d) for name, d in
+                     sorted(dirs.items(), key=lambda i: -i[1]['self_wall'])],
+        runids=runids)
+
+
+def _print_report(r, nice):
+    run = r['run']
+    print('Run %d: %d targets built, %d failed'
+          % (run['runid'], run['targets'], run['failed']))
+    print('  wall time:    %s' % _dur(run['wall']))
+    print('  CPU time:     %s' % _dur(run['cpu']))
+    print('  parallelism:  %.1f jobs, using %.1f CPUs, on average'
+          % (run['parallelism'], run['cpu_usage']))
+    print('  peak memory:  %s' % _mem(run['maxrss']))
+    if run['unknown_cpu']:
+        # eg. with redo --rpc; see _attribute().
+        print('  unknown CPU:  %d target%s (less than the targets they built)'
+              % (run['unknown_cpu'], run['unknown_cpu'] != 1 and 's' or ''))
+    print()
+    print('Slowest targets (not counting the targets they built):')
+    print('  %8s %8s %8s %8s  %s'
+          % ('self', 'total', 'cpu', 'memory', 'target'))
+    for t in r['slowest']:
+        print('  %8s %8s %8s %8s  %s'
+              % (_dur(t['self_wall']), _dur(t['wall']),
+                 _dur(t['self_cpu']), _mem(t['maxrss']), nice(t['name'])))
+    print()
+    print('By directory:')
+    print('  %8s %8s %8s  %s' % ('self', 'cpu', 'targets', 'directory'))
+    for d in r['directories']:
+        print('  %8s %8s %8d  %s'
+              % (_dur(d['self_wall']), _dur(d['self_cpu']), d['targets'],
+                 nice(d['name'])))
+    print()
+    print('Trend (self time in the last %d runs, oldest first):'
+          % len(r['runids']))
+    for t in r['slowest']:
+        print('  %s  %s' % (' '.join('%8s' % _dur(secs)
+                                     for secs in t['trend']),
+                            nice(t['name'])))
+
+
+def _count(o, name, v, least):
+    """Return the value v of option name as an int, or die if it isn't one."""
+    try:
+        n = int(v)
+    except (TypeError, ValueError):
+        n = None
+    if n is None or n < least:
+        o.fatal('%s must be a whole number, at least %d: %r'
+                % (name, least, v))
+    return n
+
+
+def main():
+    o = options.Options(optspec)
+    (opt, _, targets) = o.parse(sys.argv[1:])
+    top = _count(o, '--top', opt.top, 0)
+    runs = _count(o, '--runs', opt.runs, 1)
+
+    state.init([])
+    logs.setup(
+        tty=sys.stderr, parent_logs=env.v.LOG,
+        pretty=env.v.PRETTY, color=env.v.COLOR)
+
+    cwd = os.getcwd()
+    def nice(name):
+        return state.relpath(os.path.join(env.v.BASE, name), cwd) or '.'
+    names = set(state.relpath(os.path.abspath(t), env.v.BASE)
+                for t in targets)
+
+    runids = state.stats_runids(runs)
+    builds = [_Build(row) for row in state.stats(runids)]
+    deps = state.dep_ids()
+    for runid in runids:
+        _attribute([b for b in builds if b.runid == runid], deps)
+
+    if not builds:
+        if opt.json:
+            print(json.dumps(None))
+        else:
+            sys.stderr.write('redo-stats: no targets have been built yet.\n')
+        return
+    report = _report(runids, builds, names, top)
+    if opt.json:
+        for t in report['slowest']:
+            t['name'] = nice(t['name'])
+        for d in report['directories']:
+            d['name'] = nice(d['name'])
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        _print_report(report, nice)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""redo-wait: wait for the targets started by redo-ifchange --start."""
+import errno, fcntl, os, sys
+from . import env, jobserver, logs, state
+
+
+def _wait(path):
+    """Wait for the background job that owns path; return its exit code."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            # Still running.  Let the background jobs have our token while
+            # we wait for them.
+            if jobserver.has_token():
+                jobserver.release_mine()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        b = os.read(fd, 100)
+    finally:
+        os.close(fd)
+    os.unlink(path)
+    try:
+        return int(b)
+    except ValueError:
+        return 1  # it died before it could tell us
+
+
+def main():
+    if len(sys.argv) > 1:
+        sys.stderr.write('%s: no arguments expected.\n' % sys.argv[0])
+        sys.exit(1)
+    try:
+        env.inherit()
+        logs.setup(
+            tty=sys.stderr, parent_logs=env.v.LOG,
+            pretty=env.v.PRETTY, color=env.v.COLOR)
+
+        me = os.path.join(env.v.STARTDIR,
+                          os.path.join(env.v.PWD, env.v.TARGET))
+        f = state.File(name=me)
+        state.commit()
+        jobsdir = state.jobsdir(f.id)
+        try:
+            names = sorted(os.listdir(jobsdir))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+        jobserver.setup(0)
+        rv = 0
+        for name in names:
+            jrv = _wait(os.path.join(jobsdir, name))
+            rv = rv or jrv
+        if names:
+            try:
+                os.rmdir(jobsdir)
+            except OSError:
+                pass  # the script started more in the meantime
+        # Like any process, we have to hold a token when we exit.
+        jobserver.ensure_token_or_cheat('redo-wait', lambda: 0)
+    except KeyboardInterrupt:
+        sys.exit(200)
+    sys.exit(rv)
+
+
+if __name__ == '__main__':
+    main()
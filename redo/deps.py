@@ -1,6 +1,6 @@
 """Code for checking redo target dependencies."""
 import os
-from . import cycles, env, state
+from . import cycles, env, helpers, state
 from .logs import debug
 
 CLEAN = 0
@@ -10,7 +10,9 @@ def isdirty(f, depth, max_changed,
             already_checked,
             is_checked=state.File.is_checked,
             set_checked=state.File.set_checked_save,
-            log_override=state.warn_override):
+            log_override=state.warn_override,
+            memo=None,
+            graph=None):
     """Determine if the given state.File needs to be built.
 
     Args:
@@ -27,6 +29,13 @@ def isdirty(f, depth, max_changed,
         been checked for dirtiness.
       log_override: a function that logs a "manual override" warning when
         needed.  (redo-ood replaces this with a no-op.)
+      memo: a dict of {file_id: result} remembering what we found for
+        each target we visit, so that shared subtrees are only evaluated
+        once.  Only reuse a memo across calls if nothing can have been
+        built in the meantime (redo-ood does this).  If None, we use
+        a new one for just this call.
+      graph: the result of state.deps_closure() for a set of targets
+        including f, or None to fetch it ourselves.
 
     Returns:
       [targets...] if we won't be sure until the given list of targets has
@@ -34,11 +43,193 @@ def isdirty(f, depth, max_changed,
       DIRTY if the given target is definitely dirty.
       CLEAN if the given target is definitely not dirty.
     """
-    if f.id in already_checked:
+    if memo is None:
+        memo = {}
+    if graph is None and not is_checked(f):
+        # Fetch the whole dependency graph below f up front, rather than
+        # asking the database for each target's dependencies as we get
+        # to it.  Targets already checked in this run are clean, so we
+        # don't need anything below them.
+        graph = state.deps_closure([f], unchecked=True)
+        if graph:
+            # We're probably about to read the stamps of most of those,
+            # so get them a directory at a time.
+            state.prime_stamps(_closure_files(f, graph, is_checked),
+                               threads=env.v.STAT_THREADS)
+    return _isdirty(f, depth, max_changed, set(already_checked),
+                    is_checked, set_checked, log_override, memo, graph)
+
+
+def should_build(t):
+    """The shouldbuildfunc for builder.run() that redo-ifchange uses."""
+    f = state.File(name=t)
+    if f.is_failed():
+        raise helpers.ImmediateReturn(32)
+    dirty = isdirty(f, depth='', max_changed=env.v.RUNID,
+                    already_checked=[])
+    return f.is_generated, dirty == [f] and DIRTY or dirty
+
+
+def _closure_files(f, graph, is_checked):
+    """Yield f and everything in graph (its closure) that it depends on.
+
+    Files that were already checked are left out, since _isdirty_self()
+    won't read their stamps.
+    """
+    yield f
+    for edges in graph.values():
+        for mode, f2 in edges:
+            if mode == 'm' and not is_checked(f2):
+                yield f2
+
+
+def _deps(f, graph):
+    """Like f.deps(), but using graph (from state.deps_closure()) if given."""
+    if f.is_override or not f.is_generated:
+        return []
+    if graph is not None and f.id in graph:
+        return graph[f.id]
+    # We don't have f's dependencies, eg. because it had already been
+    # checked when we loaded the graph, or this sqlite can't do recursive
+    # queries.  _isdirty() needs to know how many there are.
+    return list(f.deps())
+
+
+def _isdirty(f, depth, max_changed, path,
+             is_checked, set_checked, log_override, memo, graph):
+    """Check f and everything below it.
+
+    This is a depth-first walk, but with an explicit stack instead of
+    recursion, so that very long chains of dependencies (thousands of
+    sequential steps) don't run out of Python stack.  The order in which
+    targets are checked, and thus the debug output, is the same as it
+    would be if we recursed.
+    """
+    result, fr = _enter(f, depth, max_changed, path, is_checked, memo, graph)
+    if not fr:
+        return result
+    stack = [fr]
+    result = None
+    while stack:
+        fr = stack[-1]
+        if result is not None:
+            # We just finished checking fr's current dependency.
+            if result:
+                debug('%s-- DIRTY (sub)\n' % fr.depth)
+            result = fr.absorb(result)
+        while result is None and fr.i < len(fr.deps):
+            mode, f2 = fr.deps[fr.i]
+            fr.i += 1
+            if mode == 'c':
+                if os.path.exists(os.path.join(env.v.BASE, f2.name)):
+                    debug('%s-- DIRTY (created)\n' % fr.depth)
+                    result = fr.absorb(DIRTY)
+            elif mode == 'm':
+                sub, child = _enter(f2, depth=_indent(fr.depth),
+                                    max_changed=max(fr.f.changed_runid,
+                                                    fr.f.checked_runid or 0),
+                                    path=path,
+                                    is_checked=is_checked,
+                                    memo=memo,
+                                    graph=graph)
+                if child:
+                    stack.append(child)
+                    break
+                if sub:
+                    debug('%s-- DIRTY (sub)\n' % fr.depth)
+                result = fr.absorb(sub)
+            else:
+                assert mode in ('c', 'm')
+        if stack[-1] is not fr:
+            # Finish checking the new child before coming back to fr.
+            continue
+        if result is None:
+            result = fr.finish(set_checked, log_override)
+        stack.pop()
+        path.discard(fr.f.id)
+        memo[fr.f.id] = result
+    return result
+
+
+def _indent(depth):
+    """Return the debug indentation string for one level below depth."""
+    # depth is only used for debug output.  Don't build ever-longer strings
+    # for each level of a very deep tree if nobody will see them.
+    if env.v.DEBUG >= 1:
+        return depth + '  '
+    return depth
+
+
+class _Frame(object):
+    """A target whose dependencies _isdirty() is partway through checking."""
+    __slots__ = ['f', 'depth', 'deps', 'i', 'must_build']
+
+    def __init__(self, f, depth, deps):
+        self.f = f
+        self.depth = depth
+        self.deps = deps
+        self.i = 0
+        self.must_build = []
+
+    def absorb(self, dirty):
+        """Take into account the dirtiness of our current dependency.
+
+        Returns our own result if that settles it, or None if we need to
+        keep going.
+        """
+        if not self.f.csum:
+            # f is a "normal" target: dirty f2 means f is instantly dirty
+            if dirty == DIRTY:
+                # f2 is definitely dirty, so f definitely needs to
+                # redo.
+                return DIRTY
+            elif isinstance(dirty, list):
+                # our child f2 might be dirty, but it's not sure yet.  It's
+                # given us a list of targets we have to redo in order to
+                # be sure.
+                self.must_build += dirty
+        else:
+            # f is "checksummable": dirty f2 means f needs to redo,
+            # but f might turn out to be clean after that (ie. our parent
+            # might not be dirty).
+            if dirty == DIRTY:
+                # f2 is definitely dirty, so f definitely needs to
+                # redo.  However, after that, f might turn out to be
+                # unchanged.
+                return [self.f]
+            elif isinstance(dirty, list):
+                # our child f2 might be dirty, but it's not sure yet.  It's
+                # given us a list of targets we have to redo in order to
+                # be sure.
+                self.must_build += dirty
+        return None
+
+    def finish(self, set_checked, log_override):
+        """Return our result once all our dependencies have been checked."""
+        if self.must_build:
+            # f is *maybe* dirty because at least one of its children is
+            # maybe dirty.  must_build has accumulated a list of "topmost"
+            # uncertain objects in the tree.  If we build all those, we can
+            # then redo-ifchange f and it won't have any uncertainty next
+            # time.
+            return self.must_build
+        debug('%s-- CLEAN\n' % (self.depth,))
+
+        # if we get here, it's because the target is clean
+        if self.f.is_override:
+            log_override(self.f.name)
+        set_checked(self.f)
+        return CLEAN
+
+
+def _enter(f, depth, max_changed, path, is_checked, memo, graph):
+    """Start checking f, as a dependency of something with max_changed.
+
+    Returns (result, None) if we can tell right away whether f is dirty,
+    or (None, frame) if we have to check its dependencies first.
+    """
+    if f.id in path:
         raise cycles.CyclicDependencyError()
-    # make a copy of the list, so upon returning, our parent's copy
-    # is unaffected
-    already_checked = list(already_checked) + [f.id]
 
     if env.v.DEBUG >= 1:
         debug('%s?%s %r,%r\n'
@@ -46,14 +237,39 @@ def isdirty(f, depth, max_changed,
 
     if f.failed_runid:
         debug('%s-- DIRTY (failed last time)\n' % depth)
-        return DIRTY
+        return DIRTY, None
     if f.changed_runid is None:
         debug('%s-- DIRTY (never built)\n' % depth)
-        return DIRTY
+        return DIRTY, None
     if f.changed_runid > max_changed:
         debug('%s-- DIRTY (built %d > %d; %d)\n'
               % (depth, f.changed_runid, max_changed, env.v.RUNID))
-        return DIRTY  # has been built more recently than parent
+        return DIRTY, None  # has been built more recently than parent
+
+    # Everything past this point depends only on f, not on which parent
+    # we came from, so we can remember the answer.
+    if f.id in memo:
+        dirty = memo[f.id]
+        if env.v.DEBUG >= 1:
+            debug('%s-- %s (already seen)\n'
+                  % (depth, dirty == CLEAN and 'CLEAN' or 'DIRTY'))
+        return dirty, None
+    dirty = _isdirty_self(f, depth, is_checked)
+    if dirty is not None:
+        memo[f.id] = dirty
+        return dirty, None
+    # path is the set of targets between the toplevel and f.  Instead of
+    # copying it at every level, we add ourselves on the way down and
+    # remove ourselves on the way back up.
+    path.add(f.id)
+    return None, _Frame(f, depth, _deps(f, graph))
+
+
+def _isdirty_self(f, depth, is_checked):
+    """Check whether f itself has changed.
+
+    Returns None if f is unchanged, so it comes down to its dependencies.
+    """
     if is_checked(f):
         if env.v.DEBUG >= 1:
             debug('%s-- CLEAN (checked)\n' % depth)
@@ -63,6 +279,14 @@ def isdirty(f, depth, max_changed,
         return DIRTY
 
     newstamp = f.read_stamp()
+    if (f.stamp != newstamp and env.v.HASH_SOURCES and
+            not f.is_generated and f.same_content(newstamp)):
+        # Only the stamp changed (eg. it was touched, or checked out
+        # again), not the content.  Use the new stamp, but don't count it
+        # as a change.  Don't save it here: set_checked() does that once
+        # we're done with f, unless it's redo-ood's, which writes nothing.
+        debug('%s-- CLEAN (same content)\n' % depth)
+        f.stamp = newstamp
     if f.stamp != newstamp:
         if newstamp == state.STAMP_MISSING:
             debug('%s-- DIRTY (missing)\n' % depth)
@@ -84,63 +308,4 @@ def isdirty(f, depth, max_changed,
             return [f]
         else:
             return DIRTY
-
-    must_build = []
-    for mode, f2 in f.deps():
-        dirty = CLEAN
-        if mode == 'c':
-            if os.path.exists(os.path.join(env.v.BASE, f2.name)):
-                debug('%s-- DIRTY (created)\n' % depth)
-                dirty = DIRTY
-        elif mode == 'm':
-            sub = isdirty(f2, depth=depth + '  ',
-                          max_changed=max(f.changed_runid,
-                                          f.checked_runid or 0),
-                          already_checked=already_checked,
-                          is_checked=is_checked,
-                          set_checked=set_checked,
-                          log_override=log_override)
-            if sub:
-                debug('%s-- DIRTY (sub)\n' % depth)
-                dirty = sub
-        else:
-            assert mode in ('c', 'm')
-        if not f.csum:
-            # f is a "normal" target: dirty f2 means f is instantly dirty
-            if dirty == DIRTY:
-                # f2 is definitely dirty, so f definitely needs to
-                # redo.
-                return DIRTY
-            elif isinstance(dirty, list):
-                # our child f2 might be dirty, but it's not sure yet.  It's
-                # given us a list of targets we have to redo in order to
-                # be sure.
-                must_build += dirty
-        else:
-            # f is "checksummable": dirty f2 means f needs to redo,
-            # but f might turn out to be clean after that (ie. our parent
-            # might not be dirty).
-            if dirty == DIRTY:
-                # f2 is definitely dirty, so f definitely needs to
-                # redo.  However, after that, f might turn out to be
-                # unchanged.
-                return [f]
-            elif isinstance(dirty, list):
-                # our child f2 might be dirty, but it's not sure yet.  It's
-                # given us a list of targets we have to redo in order to
-                # be sure.
-                must_build += dirty
-
-    if must_build:
-        # f is *maybe* dirty because at least one of its children is maybe
-        # dirty.  must_build has accumulated a list of "topmost" uncertain
-        # objects in the tree.  If we build all those, we can then
-        # redo-ifchange f and it won't have any uncertainty next time.
-        return must_build
-    debug('%s-- CLEAN\n' % (depth,))
-
-    # if we get here, it's because the target is clean
-    if f.is_override:
-        log_override(f.name)
-    set_checked(f)
-    return CLEAN
+    return None
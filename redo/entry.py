@@ -0,0 +1,62 @@
+"""The entry points of the redo-* programs installed by setup.py.
+
+Like the wrapper scripts in bin/, they all go through rpc.run(), so that
+every redo-* program can hand its work over to a server.
+"""
+from .rpc import run
+
+
+def redo():
+    run('redo')
+
+
+def always():
+    run('always')
+
+
+def gc():
+    run('gc')
+
+
+def ifchange():
+    run('ifchange')
+
+
+def ifcreate():
+    run('ifcreate')
+
+
+def log():
+    run('log')
+
+
+def ood():
+    run('ood')
+
+
+def sources():
+    run('sources')
+
+
+def stamp():
+    run('stamp')
+
+
+def stats():
+    run('stats')
+
+
+def targets():
+    run('targets')
+
+
+def unlocked():
+    run('unlocked')
+
+
+def wait():
+    run('wait')
+
+
+def whichdo():
+    run('whichdo')
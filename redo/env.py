@@ -44,6 +44,11 @@ class Env(object):
         self.RUNID = _get_int('REDO_RUNID', '') or None
         self.UNLOCKED = _get_bool('REDO_UNLOCKED', '')
         self.NO_OOB = _get_bool('REDO_NO_OOB', '')
+        self.STAT_THREADS = _get_int('REDO_STAT_THREADS', '')
+        self.HASH_SOURCES = _get_bool('REDO_HASH_SOURCES', '')
+        self.AUTO_STAMP = _get_bool('REDO_AUTO_STAMP', '')
+        self.CACHE_DIR = _get('REDO_CACHE_DIR', '')
+        self.PREFETCH = _get_bool('REDO_PREFETCH', '')
 
 
 def inherit():
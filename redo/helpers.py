@@ -1,5 +1,5 @@
 """Some helper functions that don't fit anywhere else."""
-import os, errno, fcntl
+import os, errno, fcntl, sys
 
 
 class ImmediateReturn(Exception):
@@ -35,3 +35,52 @@ def fd_exists(fd):
     except IOError:
         return False
     return True
+
+
+# ioctl to share the blocks of one file with another (a "reflink"), on
+# filesystems like btrfs and xfs.
+_FICLONE = sys.platform.startswith('linux') and 0x40049409 or None
+
+
+def copy_fd(src, dst, size):
+    """Copy the first size bytes of file descriptor src to dst.
+
+    We let the kernel do as much of the work as it can: best is a reflink,
+    which doesn't copy any data at all, then copy_file_range() and
+    sendfile(), which at least don't copy it through userspace.  If all
+    else fails, we copy it ourselves.
+    """
+    if _FICLONE:
+        try:
+            fcntl.ioctl(dst, _FICLONE, src)
+            return
+        except (IOError, OSError):
+            pass  # not supported here; fall through
+    ofs = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while ofs < size:
+                n = os.copy_file_range(src, dst, size - ofs, ofs, ofs)
+                if not n:
+                    break
+                ofs += n
+        except OSError:
+            pass
+    if ofs < size and hasattr(os, 'sendfile'):
+        os.lseek(dst, ofs, os.SEEK_SET)
+        try:
+            while ofs < size:
+                n = os.sendfile(dst, src, ofs, size - ofs)
+                if not n:
+                    break
+                ofs += n
+        except OSError:
+            pass
+    os.lseek(src, ofs, os.SEEK_SET)
+    os.lseek(dst, ofs, os.SEEK_SET)
+    while 1:
+        b = os.read(src, 1024*1024)
+        if not b:
+            break
+        while b:
+            b = b[os.write(dst, b):]
@@ -72,11 +72,12 @@
 # Sorry this is so complicated.  I couldn't think of a way to make it
 # simpler :)
 #
-import sys, os, errno, select, fcntl, signal
+import sys, os, errno, select, fcntl, signal, time
 from . import env, helpers, logs, state
 from .atoi import atoi
 
 _toplevel = 0
+_maxjobs = 0
 _mytokens = 1
 _cheats = 0
 _tokenfds = None
@@ -211,7 +212,7 @@ def setup(maxjobs):
         just use that.  If zero and we didn't inherit a jobserver, create
         one with a default number of tokens (currently always 1).
     """
-    global _tokenfds, _cheatfds, _toplevel
+    global _tokenfds, _cheatfds, _toplevel, _maxjobs
     assert maxjobs >= 0
     assert not _tokenfds
     _debug('setup(%d)\n' % maxjobs)
@@ -254,6 +255,8 @@ def setup(maxjobs):
             # user requested zero tokens, which means use the parent jobserver
             # if it exists.
             _tokenfds = (a, b)
+            # 0 if we don't know, eg. because our parent is GNU make.
+            _maxjobs = atoi(os.getenv('REDO_JOBS', ''))
 
     cheats = os.getenv('REDO_CHEATFDS', '') if not maxjobs else ''
     _cheatfds = None
@@ -277,7 +280,8 @@ def setup(maxjobs):
     if not _tokenfds:
         # need to start a new server
         realmax = maxjobs or 1
-        _toplevel = realmax
+        _toplevel = _maxjobs = realmax
+        os.environ['REDO_JOBS'] = str(realmax)
         _tokenfds = _make_pipe(100)
         _create_tokens(realmax - 1)
         _release_except_mine()
@@ -287,6 +291,11 @@ def setup(maxjobs):
              _tokenfds[0], _tokenfds[1]))
 
 
+def parallel():
+    """Return true if there might be more than one job running at a time."""
+    return _maxjobs != 1
+
+
 def _wait(want_token, max_delay):
     """Wait for a subproc to die or, if want_token, tokenfd to be readable.
 
@@ -330,10 +339,16 @@ def _wait(want_token, max_delay):
                     _release_except_mine()
             os.close(fd)
             del _waitfds[fd]
-            rv = os.waitpid(pd.pid, 0)
-            assert rv[0] == pd.pid
+            pid, rv, ru = os.wait4(pd.pid, 0)
+            assert pid == pd.pid
             _debug("done1: rv=%r\n" % (rv,))
-            rv = rv[1]
+            pd.wall = time.time() - pd.start_time
+            pd.utime = ru.ru_utime
+            pd.stime = ru.ru_stime
+            # kilobytes on Linux, but bytes on MacOS.
+            pd.maxrss = ru.ru_maxrss
+            if sys.platform == 'darwin':
+                pd.maxrss //= 1024
             if os.WIFEXITED(rv):
                 pd.rv = os.WEXITSTATUS(rv)
             else:
@@ -387,6 +402,17 @@ def _ensure_token(reason, max_delay=None):
     assert _mytokens <= 1
 
 
+def try_token(reason):
+    """Get a job token, but only if one is available right now.
+
+    Returns:
+      True if this process now has a token.
+    """
+    if not has_token():
+        _ensure_token(reason, max_delay=0)
+    return has_token()
+
+
 def ensure_token_or_cheat(reason, cheatfunc):
     """Wait for a job token to become available, or cheat if possible.
 
@@ -487,6 +513,35 @@ def force_return_tokens():
     assert state.is_flushed()
 
 
+def borrow_token(reason):
+    """Trade the token we started with for one of our own.
+
+    Every process owns a token when it starts: the one its parent gave
+    up to start it.  A process that keeps running in the background,
+    while its parent goes on with something else, can't use that one,
+    so it has to wait for a real token instead.  It must give that back
+    with return_borrowed() before it exits.
+    """
+    global _mytokens
+    assert _mytokens == 1
+    _mytokens = 0
+    _ensure_token(reason)
+
+
+def return_borrowed():
+    """Instead of force_return_tokens(), after borrow_token().
+
+    Nobody gave up a token to start us, so we don't keep one at exit.
+    """
+    n = len(_waitfds)
+    for k in list(_waitfds):
+        del _waitfds[k]
+    _create_tokens(n)
+    # Cheater tokens just disappear; all the real ones go back in the pipe.
+    _release(_mytokens)
+    assert state.is_flushed()
+
+
 class Job(object):
     """Metadata about a running job."""
 
@@ -503,6 +558,12 @@ class Job(object):
         self.pid = pid
         self.rv = None
         self.donefunc = donefunc
+        self.start_time = time.time()
+        # Filled in when the job exits.  The times are in seconds, and
+        # maxrss (the peak memory use) in kilobytes.  Like the exit code,
+        # they come from the subprocess, but they also include any
+        # subprocesses it waited for.
+        self.wall = self.utime = self.stime = self.maxrss = None
 
     def __repr__(self):
         return 'Job(%s,%d)' % (self.name, self.pid)
@@ -520,6 +581,9 @@ def start(reason, jobfunc, donefunc):
         process (the one which ran start()).
       donefunc: the function(reason, return_value) to call **in the parent**
         when the subprocess exits.
+    Returns:
+      The Job.  Once donefunc has been called, it says how long the job
+      took and how much it used.
     """
     assert state.is_flushed()
     assert _mytokens <= 1
@@ -547,3 +611,4 @@ def start(reason, jobfunc, donefunc):
     os.close(w)
     pd = Job(reason, pid, donefunc)
     _waitfds[r] = pd
+    return pd
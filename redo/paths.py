@@ -40,12 +40,21 @@ def possible_do_files(t):
 
 
 def find_do_file(f):
+    found = None
+    missing = []
     for dodir, dofile, basedir, basename, ext in possible_do_files(f.name):
         dopath = os.path.join(dodir, dofile)
         debug2('%s: %s:%s ?\n' % (f.name, dodir, dofile))
         if os.path.exists(dopath):
-            f.add_dep('m', dopath)
-            return dodir, dofile, basedir, basename, ext
+            found = dopath
+            break
         else:
-            f.add_dep('c', dopath)
+            missing.append(dopath)
+    # Record all the .do files that didn't exist at once, rather than one
+    # at a time.
+    if missing:
+        f.add_deps('c', missing)
+    if found:
+        f.add_dep('m', found)
+        return dodir, dofile, basedir, basename, ext
     return None, None, None, None, None
@@ -0,0 +1,286 @@
+"""Run redo commands from .do scripts in a process that's already warm.
+
+Every redo-ifchange in a .do script is a new python process, and starting
+python (and importing everything redo needs) often takes longer than the
+actual work, especially for scripts that run redo-ifchange once per file.
+
+So with redo --rpc, the toplevel redo forks a server before it does
+anything else, and passes a socket connected to it to all its subprocesses
+in $REDO_RPC_FD.
+Instead of doing the work itself, a redo command run by a .do script sends
+its argv, environment, current directory and all its open file descriptors
+to the server.  The server forks a worker, which already has everything
+imported.  The worker sets itself up to look just like the process that
+sent the request, runs the command, and sends back its exit code.
+
+Every redo-<cmd> program starts in run(), here, whether it's one of the
+thin wrapper scripts in bin/ or installed by setup.py, so this module must
+stay cheap to import.
+
+Since a forwarded command runs in the server, not in the .do script that
+ran it, it isn't subject to any limits the .do script set for itself and
+its children, like ulimit, nice or a cgroup, and the CPU time it uses
+doesn't count towards the .do script's in the build stats.  That's why
+it's off by default.
+"""
+import array, errno, fcntl, marshal, os, signal, socket, sys
+
+# The commands we can run in the server.  They must not fork into the
+# background or need to be the parent of any particular process.
+COMMANDS = ('ifchange', 'ifcreate', 'always', 'stamp', 'log')
+
+# SCM_RIGHTS can pass at most 253 fds at once on Linux.
+MAX_FDS = 200
+MAX_MSG = 1024*1024
+
+
+def _fds():
+    """Return the fds that exec() would leave open in this process, or None."""
+    for fddir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            names = os.listdir(fddir)
+        except OSError:
+            continue
+        fds = []
+        for name in names:
+            fd = int(name)
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            except (IOError, OSError):
+                continue  # eg. the one listdir() just closed
+            if not flags & fcntl.FD_CLOEXEC:
+                fds.append(fd)
+        return sorted(fds)
+    return None
+
+
+def _send(sock, cmd):
+    """Ask the server on sock to run redo-<cmd> for us.
+
+    Returns:
+      The socket the reply will arrive on, or None if we can't send the
+      request, in which case the caller should run the command itself.
+    """
+    r, w = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        mine = (sock.fileno(), r.fileno(), w.fileno())
+        fds = [fd for fd in _fds() or [] if fd not in mine]
+        if not fds or len(fds) > MAX_FDS:
+            r.close()
+            return None
+        umask = os.umask(0)
+        os.umask(umask)
+        # Not json: importing it takes longer than all the rest of this.
+        msg = marshal.dumps(dict(cmd=cmd, argv=sys.argv, cwd=os.getcwd(),
+                                 env=dict(os.environ), umask=umask,
+                                 fds=fds))
+        try:
+            sock.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                  array.array('i', [w.fileno()] + fds))])
+        except OSError:
+            # eg. the server is gone, or the message is too big.
+            r.close()
+            return None
+    finally:
+        sock.close()
+        w.close()
+    return r
+
+
+def _reply(r, cmd):
+    """Wait for the server's reply on r, and return the rv it contains."""
+    f = r.makefile('rb')
+    try:
+        b = f.read()
+    except KeyboardInterrupt:
+        return 200
+    if not b:
+        sys.stderr.write('redo-%s: server died while running %r\n'
+                         % (cmd, sys.argv))
+        return 1
+    return int(b)
+
+
+def call(cmd):
+    """Have a server run redo-<cmd>, with our sys.argv, if there is one.
+
+    That's the server the toplevel redo started (see start_server()).
+
+    Returns:
+      The command's exit code, or None if the caller has to run it itself.
+    """
+    if not hasattr(socket.socket, 'sendmsg'):
+        return None
+    rpcfd = os.environ.get('REDO_RPC_FD')
+    if not rpcfd or not os.environ.get('REDO_RPC') or cmd not in COMMANDS:
+        return None
+    if cmd == 'ifchange' and sys.argv[1:2] == ['--start']:
+        return None  # it keeps running in the background after we exit
+    try:
+        sock = socket.fromfd(int(rpcfd), socket.AF_UNIX,
+                             socket.SOCK_SEQPACKET)
+    except (OSError, ValueError):
+        return None  # someone closed it
+    r = _send(sock, cmd)
+    return r and _reply(r, cmd)
+
+
+def forward(cmd):
+    """If a server can run redo-<cmd> for us, exit with its rv.
+
+    Otherwise, return, so that the caller can run the command itself.
+    """
+    rv = call(cmd)
+    if rv is not None:
+        sys.exit(rv)
+
+
+def run(cmd):
+    """Run redo-<cmd>: in a server, if there is one, or else right here.
+
+    This is the entry point of every redo-<cmd> program.
+    """
+    forward(cmd)
+    from . import title
+    mod = __import__('redo.cmd_' + cmd, fromlist=['main'])
+    title.auto()
+    mod.main()
+
+
+def start_server():
+    """Fork the server, and set $REDO_RPC_FD so our subprocesses can use it.
+
+    Call this in the toplevel redo before anything else, so that the server
+    doesn't inherit an open database or anything else that belongs to us.
+    """
+    if not hasattr(socket.socket, 'sendmsg') or not os.environ.get('REDO_RPC'):
+        return
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    _preload(COMMANDS)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        rv = 0
+        try:
+            ours.close()
+            _serve(theirs)
+        except KeyboardInterrupt:
+            pass
+        except Exception:  # pylint: disable=broad-except
+            import traceback
+            traceback.print_exc()
+            rv = 1
+        os._exit(rv)
+    theirs.close()
+    fd = ours.detach()
+    os.set_inheritable(fd, True)
+    os.environ['REDO_RPC_FD'] = str(fd)
+
+
+def _preload(cmds):
+    """Import everything the workers will need, so they don't have to."""
+    for cmd in cmds:
+        # redo-log reads its options and directory when it's imported, so
+        # each worker has to import it for itself.  What it needs from the
+        # rest of redo is loaded by the other commands.
+        if cmd != 'log':
+            __import__('redo.cmd_' + cmd)
+
+
+def _serve(sock):
+    """Run a worker for each request on sock until nobody can send any."""
+    # Don't leave zombie workers around.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while 1:
+        msg, fds = _recv(sock)
+        if not msg:
+            return  # every process with the other end has exited
+        if os.fork() == 0:
+            sock.close()
+            _work(msg, fds)
+        for fd in fds:
+            os.close(fd)
+
+
+def _recv(sock):
+    """Receive a request from sock.
+
+    Returns:
+      (msg, fds), where msg is empty if nobody can send us anything anymore.
+    """
+    fdsize = array.array('i').itemsize
+    while 1:
+        try:
+            msg, anc, _, _ = sock.recvmsg(
+                MAX_MSG, socket.CMSG_SPACE((MAX_FDS + 1) * fdsize))
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        fds = array.array('i')
+        for level, kind, data in anc:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fdsize])
+        return msg, list(fds)
+
+
+def _work(msg, fds):
+    """Handle one request in a worker process.  Never returns."""
+    rv = 1
+    reply = fds[0]
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        req = marshal.loads(msg)
+        reply = _move_fds(fds, [None] + req['fds'])[0]
+        os.environ.clear()
+        os.environ.update(req['env'])
+        os.chdir(req['cwd'])
+        os.umask(req['umask'])
+        sys.argv = req['argv']
+        assert req['cmd'] in COMMANDS, req['cmd']
+        __import__('redo.cmd_' + req['cmd'])
+        sys.modules['redo.cmd_' + req['cmd']].main()
+        rv = 0
+    except SystemExit as e:
+        if e.code is None:
+            rv = 0
+        elif isinstance(e.code, int):
+            rv = e.code
+        else:
+            sys.stderr.write('%s\n' % e.code)
+    except KeyboardInterrupt:
+        rv = 200
+    except Exception:  # pylint: disable=broad-except
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.write(reply, ('%d' % rv).encode('ascii'))
+        finally:
+            os._exit(rv)
+
+
+def _move_fds(got, want):
+    """Renumber each fd in got to the matching number in want.
+
+    Returns:
+      The new numbers of the fds whose number in want is None.
+    """
+    # Get them all out of the way first, so dup2() can't clobber one we
+    # still need.
+    low = max(got + [num for num in want if num is not None]) + 1
+    tmp = []
+    for fd in got:
+        tmp.append(fcntl.fcntl(fd, fcntl.F_DUPFD, low))
+        os.close(fd)
+    others = []
+    for fd, num in zip(tmp, want):
+        if num is None:
+            others.append(fd)
+        else:
+            os.dup2(fd, num)
+            os.close(fd)
+    return others
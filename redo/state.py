@@ -1,15 +1,18 @@
 """Code for manipulating redo's state database."""
-import sys, os, errno, stat, fcntl, sqlite3
+import sys, os, errno, hashlib, re, stat, fcntl, sqlite3
 from . import cycles, env
 from .helpers import unlink, close_on_exec
 from .logs import warn, debug2, debug3
 
-SCHEMA_VER = 2
+SCHEMA_VER = 6
 TIMEOUT = 60
 
 ALWAYS = '//ALWAYS'   # an invalid filename that is always marked as dirty
-STAMP_DIR = 'dir'     # the stamp of a directory; mtime is unhelpful
-STAMP_MISSING = '0'   # the stamp of a nonexistent file
+
+# A stamp is a tuple of (mtime_ns, size, ino, mode, uid, gid) for a file.
+# For a symlink, that's followed by the same again for what it points at.
+STAMP_DIR = (0, 0, 0, stat.S_IFDIR, 0, 0)  # a directory; mtime is unhelpful
+STAMP_MISSING = (0, 0, 0, 0, 0, 0)         # a nonexistent file
 
 LOG_LOCK_MAGIC = 0x10000000  # fid offset for "log locks"
 
@@ -66,13 +69,20 @@ def db():
         except sqlite3.OperationalError:
             row = None
         ver = row and row[0] or None
+        while ver in _migrations:
+            ver = _upgrade(_db, ver, _migrations[ver])
         if ver != SCHEMA_VER:
             # Don't use err() here because this might happen before
             # redo-log spawns.
             sys.stderr.write(
                 'redo: %s: found v%s (expected v%s)\n'
                 % (dbfile, ver, SCHEMA_VER))
-            sys.stderr.write('redo: manually delete .redo dir to start over.\n')
+            if isinstance(ver, int) and ver > SCHEMA_VER:
+                sys.stderr.write('redo: database was created by a newer '
+                                 'redo; upgrade redo to use it.\n')
+            else:
+                sys.stderr.write(
+                    'redo: manually delete .redo dir to start over.\n')
             sys.exit(1)
     if must_create:
         unlink(dbfile)
@@ -81,21 +91,15 @@ def db():
                     "    (version int)")
         _db.execute("create table Runid "
                     "    (id integer primary key autoincrement)")
-        _db.execute("create table Files "
-                    "    (name not null primary key, "
-                    "     is_generated int, "
-                    "     is_override int, "
-                    "     checked_runid int, "
-                    "     changed_runid int, "
-                    "     failed_runid int, "
-                    "     stamp, "
-                    "     csum)")
+        _db.execute(_files_table('Files'))
         _db.execute("create table Deps "
                     "    (target int, "
                     "     source int, "
                     "     mode not null, "
                     "     delete_me int, "
                     "     primary key (target,source))")
+        _db.execute(_hashes_table)
+        _db.execute(_stats_table)
         _db.execute("insert into Schema (version) values (?)", [SCHEMA_VER])
         # eat the '0' runid and File id.
         # Because of the cheesy way t/flush-cache is implemented, leave a
@@ -114,11 +118,177 @@ def db():
     return _db
 
 
+def _files_table(name):
+    """Return the statement that creates the Files table with this name."""
+    # Deps and the log files refer to Files by id, so it has to be an
+    # explicit integer primary key: otherwise, VACUUM can renumber the rows.
+    return ("create table %s "
+            "    (id integer primary key, "
+            "     name not null unique, "
+            "     is_generated int, "
+            "     is_override int, "
+            "     checked_runid int, "
+            "     changed_runid int, "
+            "     failed_runid int, "
+            "     %s, "
+            "     csum)" % (name, ', '.join('%s int' % c for c in _stamp_cols)))
+
+
+# The content hash of each version of a file we've hashed, by its stamp.
+# See content_hash().
+_hashes_table = ("create table Hashes "
+                 "    (mtime_ns int, "
+                 "     size int, "
+                 "     ino int, "
+                 "     hash not null, "
+                 "     primary key (mtime_ns, size, ino))")
+
+
+# How long each target took to build in each run, and how much CPU time and
+# memory it used.  See add_stats().
+_stats_table = ("create table Stats "
+                "    (runid int, "
+                "     target int, "
+                "     start real, "
+                "     wall real, "
+                "     utime real, "
+                "     stime real, "
+                "     maxrss int, "
+                "     rv int, "
+                "     primary key (runid, target))")
+
+
+def _upgrade(d, ver, func):
+    """Run func(d) to upgrade the database from schema version ver.
+
+    The whole upgrade happens in one transaction, so if it fails (or we
+    get killed), the database is left exactly as it was, and the next
+    redo will try again.
+
+    Returns:
+      The schema version afterwards, normally ver+1.
+    """
+    # Do our own transactions, since some versions of python's sqlite3
+    # module commit automatically before "create table" and friends.
+    d.isolation_level = None
+    try:
+        d.execute('begin immediate')
+        try:
+            # Someone else might have done it while we waited for the lock.
+            (got,) = d.execute('select version from Schema').fetchone()
+            if got == ver:
+                func(d)
+                got = ver + 1
+                d.execute('update Schema set version=?', [got])
+            d.execute('commit')
+        except:
+            d.execute('rollback')
+            raise
+    finally:
+        d.isolation_level = ''
+    return got
+
+
+def _upgrade_v2(d):
+    """Upgrade from v2, which stored stamps as strings, to v3.
+
+    To avoid rebuilding everything, we stat each file again and compare
+    with the stamp string v2 would have produced.  If they match, the file
+    hasn't changed since the last build, and we can store its new stamp.
+    Otherwise, we convert the old string as well as we can, which won't
+    match the new stamp, so the file is dirty just like it was.
+    """
+    rows = d.execute('select rowid, name, is_generated, is_override, '
+                     '    checked_runid, changed_runid, failed_runid, '
+                     '    stamp, csum '
+                     '  from Files').fetchall()
+    d.execute(_files_table('NewFiles'))
+    d.executemany('insert into NewFiles (%s) values (%s)'
+                  % (', '.join(_file_cols), ','.join('?' * len(_file_cols))),
+                  [list(row[0:7]) + _stamp_to_cols(_v2_stamp(row[1], row[7])) +
+                   [row[8]]
+                   for row in rows])
+    d.execute('drop table Files')
+    d.execute('alter table NewFiles rename to Files')
+
+
+def _v2_stamp(name, old):
+    """Convert a v2 stamp string for the given File name (see _upgrade_v2)."""
+    if not old:
+        return None
+    def v2(statfunc):
+        try:
+            st = statfunc(os.path.join(env.v.BASE, name))
+        except OSError:
+            return False, '0'
+        if stat.S_ISDIR(st.st_mode):
+            return False, 'dir'
+        return (stat.S_ISLNK(st.st_mode),
+                '-'.join(str(s) for s in
+                         ('%.6f' % st.st_mtime, st.st_size, st.st_ino,
+                          st.st_mode, st.st_uid, st.st_gid)))
+    is_link, cur = v2(os.lstat)
+    if is_link:
+        cur += '+' + v2(os.stat)[1]
+    if cur == old:
+        is_link, new = _stat_stamp(name, os.lstat)
+        if is_link:
+            new += _stat_stamp(name, os.stat)[1]
+        return new
+    new = ()
+    for part in old.split('+'):
+        g = re.match(r'^(-?\d+\.\d+)-(\d+)-(\d+)-(\d+)-(\d+)-(\d+)$', part)
+        if part == '0':
+            new += STAMP_MISSING
+        elif part == 'dir':
+            new += STAMP_DIR
+        elif g:
+            new += ((int(round(float(g.group(1)) * 1000000)) * 1000,) +
+                    tuple(int(i) for i in g.groups()[1:]))
+        else:
+            return (-1, -1, 0, 0, 0, 0)  # can't match any real file
+    return new
+
+
+def _upgrade_v3(d):
+    """Upgrade from v3 to v4, which gave Files an explicit id column."""
+    cols = ', '.join(_file_cols)
+    d.execute(_files_table('NewFiles'))
+    d.execute('insert into NewFiles (%s) select %s from Files' % (cols, cols))
+    d.execute('drop table Files')
+    d.execute('alter table NewFiles rename to Files')
+
+
+def _upgrade_v4(d):
+    """Upgrade from v4 to v5, which added the Hashes table."""
+    d.execute(_hashes_table)
+
+
+def _upgrade_v5(d):
+    """Upgrade from v5 to v6, which added the Stats table."""
+    d.execute(_stats_table)
+
+
+# How to upgrade the database from each old schema version to the next one.
+# When you change the schema, increment SCHEMA_VER and add a function here
+# that converts the previous version in place; _upgrade() takes care of
+# the transaction and the version number.  That way, people who upgrade
+# redo don't have to throw away .redo (and rebuild everything).  Databases
+# older than the oldest version listed here can't be upgraded.
+#
+# t/380-migrate keeps a database from every version listed here, to make
+# sure they all still upgrade to the current version.
+_migrations = {
+    2: _upgrade_v2,
+    3: _upgrade_v3,
+    4: _upgrade_v4,
+    5: _upgrade_v5,
+}
+
+
 def init(targets):
     env.init(targets)
-    db()
-    if env.is_toplevel and detect_broken_locks():
-        env.mark_locks_broken()
+    db()  # which also checks for broken locks, if we're the toplevel
 
 
 _wrote = 0
@@ -127,7 +297,16 @@ def _write(q, l):
         return
     global _wrote
     _wrote += 1
-    db().execute(q, l)
+    return db().execute(q, l)
+
+
+def _write_many(q, ll):
+    """Like _write(), but run q once for each list of args in ll."""
+    if _insane:
+        return
+    global _wrote
+    _wrote += 1
+    return db().executemany(q, ll)
 
 
 def commit():
@@ -170,10 +349,36 @@ def _realdirpath(t):
     """
     dname, fname = os.path.split(t)
     if dname:
-        dname = os.path.realpath(dname)
+        dname = _realdir(dname)
     return os.path.join(dname, fname)
 
 
+# os.path.realpath() results for absolute directory names.  relpath() gets
+# called for every File we look up and every log message we print, but
+# generally for files in only a few directories, and realpath() needs one
+# syscall per path element.  Like the stamp cache, this can go stale if
+# anyone replaces a directory with a symlink, so flush_paths() whenever
+# that might have happened.
+_realdirs = {}
+REALDIRS_MAX = 10000
+
+
+def _realdir(dname):
+    got = _realdirs.get(dname)
+    if got is None:
+        got = os.path.realpath(dname)
+        if dname.startswith('/'):
+            if len(_realdirs) >= REALDIRS_MAX:
+                _realdirs.clear()
+            _realdirs[dname] = got
+    return got
+
+
+def flush_paths():
+    """Forget cached directory names, because anything might have changed."""
+    _realdirs.clear()
+
+
 _cwd = None
 def relpath(t, base):
     """Given a relative or absolute path t, express it relative to base."""
@@ -182,6 +387,9 @@ def relpath(t, base):
         _cwd = os.getcwd()
     t = os.path.normpath(_realdirpath(os.path.join(_cwd, t)))
     base = os.path.normpath(_realdirpath(base))
+    if t.startswith(base) and t[len(base):len(base)+1] == '/':
+        # fast path: t is inside base (eg. a File relative to env.v.BASE)
+        return t[len(base)+1:]
     tparts = t.split('/')
     bparts = base.split('/')
 
@@ -229,23 +437,344 @@ def detect_override(stamp1, stamp2):
     """
     if stamp1 == stamp2:
         return False
-    crit1 = stamp1.split('-', 2)[0:2]
-    crit2 = stamp2.split('-', 2)[0:2]
-    return crit1 != crit2
+    # (mtime_ns, size) of the file itself, even if it's a symlink.
+    return stamp1[:2] != stamp2[:2]
 
 
 def warn_override(name):
     warn('%s - you modified it; skipping\n' % name)
 
 
-_file_cols = ['rowid', 'name', 'is_generated', 'is_override',
-              'checked_runid', 'changed_runid', 'failed_runid',
-              'stamp', 'csum']
+# read_stamp() results, so that we don't ask the filesystem about the same
+# file over and over during a single run.  (The same file gets stamped when
+# checking whether it's dirty, again before building it, and again after
+# building it, and so on.)  Keyed by (File.name, statfunc).
+#
+# This is only valid as long as nobody changes the files, so anything that
+# might do so (like a build script exiting, or another redo process
+# releasing a lock we were waiting for) needs to call flush_stamps(), and
+# anything we change ourselves needs forget_stamp().
+_stamps = {}
+stamp_hits = 0
+stamp_misses = 0
+stamp_primed = 0
+
+
+def _stamp_from_st(st):
+    """Return (is_link, stamp) for the given stat() result."""
+    if stat.S_ISDIR(st.st_mode):
+        # directories change too much; detect only existence.
+        return False, STAMP_DIR
+    else:
+        # a "unique identifier" stamp for a regular file
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            # python < 3.3 only has a float, good to about a microsecond.
+            mtime_ns = int(round(st.st_mtime * 1000000)) * 1000
+        ino = st.st_ino
+        if ino >= 1 << 63:
+            ino -= 1 << 64  # sqlite integers are signed 64-bit
+        return (
+            stat.S_ISLNK(st.st_mode),
+            (mtime_ns, st.st_size, ino, st.st_mode, st.st_uid, st.st_gid)
+        )
+
+
+def _stat_stamp(name, statfunc):
+    """Return (is_link, stamp) for the File with the given name."""
+    try:
+        st = statfunc(os.path.join(env.v.BASE, name))
+    except OSError:
+        return False, STAMP_MISSING
+    return _stamp_from_st(st)
+
+
+def _read_stamp_st(name, statfunc):
+    global stamp_hits, stamp_misses
+    key = (name, statfunc)
+    got = _stamps.get(key)
+    if got:
+        stamp_hits += 1
+        return got
+    stamp_misses += 1
+    got = _stamps[key] = _stat_stamp(name, statfunc)
+    return got
+
+
+def read_stamp(name):
+    """Return the current stamp of the File with the given name.
+
+    Like File.read_stamp(), but for files that might not be in the
+    database.
+    """
+    is_link, pre = _read_stamp_st(name, os.lstat)
+    if is_link:
+        # if we're a symlink, we actually care about the link object
+        # itself, *and* the target of the link.  If either changes,
+        # we're considered dirty.
+        #
+        # On the other hand, detect_override() doesn't care about the
+        # target of the link, only the link itself.
+        _, post = _read_stamp_st(name, os.stat)
+        return pre + post
+    else:
+        return pre
+
+
+def forget_stamp(name):
+    """Drop the cached stamp of the File with the given name, if any."""
+    _stamps.pop((name, os.lstat), None)
+    _stamps.pop((name, os.stat), None)
+
+
+def flush_stamps():
+    """Drop all cached stamps, because anything might have changed."""
+    _stamps.clear()
+
+
+# Don't bother listing a directory unless we want to know about at least
+# this many files in it.
+PRIME_MIN = 8
+
+
+def prime_stamps(files, threads=0):
+    """Fill the stamp cache for the given Files.
+
+    Rather than lstat()ing each file by its full path, we list each
+    directory with os.scandir().  Files that aren't in the listing are
+    missing, and subdirectories are recognizable from the listing itself,
+    so neither needs a syscall at all.  Everything else still needs an
+    lstat(), but relative to the open directory, which saves looking up
+    every element of its path again (expensive on NFS).
+
+    If threads > 1, we also stat files in directories too small to be
+    worth listing, and do all of it using that many threads at once.  On
+    a network filesystem, most of the time is spent waiting for the
+    server, so this can go a lot faster than one file at a time.
+
+    The results are the same stamps that read_stamp() would produce.
+    """
+    global stamp_primed
+    scandir = getattr(os, 'scandir', None)  # python < 3.5 doesn't have it
+    bydir = {}
+    for f in files:
+        name = f.name
+        if name.startswith('//') or (name, os.lstat) in _stamps:
+            continue
+        head, _, basename = name.rpartition('/')
+        wanted = bydir.get(head)
+        if wanted is None:
+            wanted = bydir[head] = {}
+        wanted[basename] = name
+    jobs = []
+    for head, wanted in bydir.items():
+        if scandir and len(wanted) >= PRIME_MIN:
+            jobs.append((_scan_stamps, (scandir, head, wanted)))
+        elif threads > 1:
+            jobs += [(_stat_stamps, (name,)) for name in wanted.values()]
+    if threads > 1 and len(jobs) > 1:
+        results = _run_threads(jobs, threads)
+    else:
+        results = [func(*args) for func, args in jobs]
+    for got in results:
+        for key, stamp in got:
+            _stamps[key] = stamp
+            stamp_primed += 1
+
+
+def _stat_stamps(name):
+    """Return the stamp cache entries for the File with the given name."""
+    got = _stat_stamp(name, os.lstat)
+    out = [((name, os.lstat), got)]
+    if got[0]:
+        # a symlink: read_stamp() will want its target too.
+        out.append(((name, os.stat), _stat_stamp(name, os.stat)))
+    return out
+
+
+def _scan_stamps(scandir, head, wanted):
+    """Return the stamp cache entries for files in directory head.
+
+    wanted is a dict of {basename: File.name} for the files we care about.
+    """
+    out = []
+    dirname = os.path.join(env.v.BASE, head)
+    dfd = None
+    found = {}
+    try:
+        if scandir in getattr(os, 'supports_fd', ()):
+            dfd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+            it = scandir(dfd)
+        else:
+            it = scandir(dirname)
+        try:
+            for ent in it:
+                if ent.name in wanted:
+                    found[ent.name] = ent
+                    if len(found) == len(wanted):
+                        break
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+        for basename, name in wanted.items():
+            ent = found.get(basename)
+            if not ent:
+                out.append(((name, os.lstat), (False, STAMP_MISSING)))
+            elif ent.is_dir(follow_symlinks=False):
+                out.append(((name, os.lstat), (False, STAMP_DIR)))
+            else:
+                try:
+                    got = _stamp_from_st(ent.stat(follow_symlinks=False))
+                    out.append(((name, os.lstat), got))
+                    if got[0]:
+                        # a symlink: read_stamp() will want its target too.
+                        try:
+                            post = _stamp_from_st(ent.stat())
+                        except OSError:
+                            post = (False, STAMP_MISSING)
+                        out.append(((name, os.stat), post))
+                except OSError:
+                    pass  # gone already; let read_stamp() sort it out
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            # the directory doesn't exist, so neither do the files.
+            out = [((name, os.lstat), (False, STAMP_MISSING))
+                   for name in wanted.values()]
+        # otherwise, eg. we can't read the directory; read_stamp() will
+        # find out soon enough.
+    finally:
+        if dfd is not None:
+            os.close(dfd)
+    return out
+
+
+def _run_threads(jobs, threads):
+    """Run each of jobs, a list of (func, args), in up to threads threads.
+
+    Returns a list of the results, in no particular order.
+    """
+    import threading
+    lock = threading.Lock()
+    todo = list(jobs)
+    results = []
+    def worker():
+        while 1:
+            with lock:
+                if not todo:
+                    return
+                func, args = todo.pop()
+            got = func(*args)
+            with lock:
+                results.append(got)
+    pool = [threading.Thread(target=worker)
+            for _ in range(min(threads, len(todo)))]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return results
+
+
+def _hash_file(name, stamp):
+    """Return the sha1 of the contents of the named file.
+
+    Returns None if the file's stamp isn't stamp anymore by the time we've
+    read it, since then we don't know which version we hashed.
+    """
+    try:
+        f = open(os.path.join(env.v.BASE, name), 'rb')
+    except IOError:
+        return None
+    with f:
+        sh = hashlib.sha1()
+        while 1:
+            b = f.read(1024*1024)
+            if not b:
+                break
+            sh.update(b)
+        st = os.fstat(f.fileno())
+    if _stamp_from_st(st)[1] != stamp:
+        return None
+    return sh.hexdigest()
+
+
+def content_hash(name, stamp, compute=True):
+    """Return the content hash of the named file, as of the given stamp.
+
+    We remember the hash of each version of a file, by (mtime, size,
+    inode), in the Hashes table.  That way, we only read a file if it has
+    changed since the last time we hashed it.
+
+    Args:
+      name: the name of the File.
+      stamp: the stamp the file had (or has) when it had the content we
+        want to know about.
+      compute: if true, and we've never seen this version of the file
+        before, read the file to find out.  That only works if stamp is
+        its current stamp.
+    Returns:
+      The hash, or None if we don't know (eg. it's not a regular file).
+    """
+    if not stamp or len(stamp) != 6 or not stat.S_ISREG(stamp[3]):
+        return None  # missing, a directory, a symlink, ...
+    key = list(stamp[:3])
+    row = db().execute('select hash from Hashes '
+                       '  where mtime_ns=? and size=? and ino=?',
+                       key).fetchone()
+    if row:
+        return row[0]
+    if not compute:
+        return None
+    h = _hash_file(name, stamp)
+    if h:
+        _write('insert or replace into Hashes (mtime_ns, size, ino, hash) '
+               '  values (?,?,?,?)', key + [h])
+    return h
+
+
+def forget_hashes():
+    """Forget the hashes of file versions that no File has anymore.
+
+    Returns how many we forgot.
+    """
+    return _write('delete from Hashes '
+                  '  where not exists (select 1 from Files '
+                  '    where Files.mtime_ns = Hashes.mtime_ns '
+                  '      and Files.size = Hashes.size '
+                  '      and Files.ino = Hashes.ino)', []).rowcount
+
+
+_stamp_cols = ['mtime_ns', 'size', 'ino', 'mode', 'uid', 'gid',
+               # if the file is a symlink, the same for what it points at
+               'link_mtime_ns', 'link_size', 'link_ino', 'link_mode',
+               'link_uid', 'link_gid']
+_file_cols = (['rowid', 'name', 'is_generated', 'is_override',
+               'checked_runid', 'changed_runid', 'failed_runid'] +
+              _stamp_cols + ['csum'])
+
+
+def _stamp_from_cols(cols):
+    """Return the stamp stored in the given _stamp_cols values."""
+    if cols[3] is None:
+        return None  # never stamped
+    elif cols[9] is None:
+        return tuple(cols[:6])
+    else:
+        return tuple(cols)
+
+
+def _stamp_to_cols(stamp):
+    """Return the list of _stamp_cols values that store the given stamp."""
+    if stamp is None:
+        return [None] * 12
+    return list(stamp) + [None] * (12 - len(stamp))
+
+
 class File(object):
     """An object representing a source or target in the redo database."""
 
     # use this mostly to avoid accidentally assigning to typos
-    __slots__ = ['id'] + _file_cols[1:]
+    __slots__ = ['id'] + _file_cols[1:7] + ['stamp', 'csum']
 
     # These warnings are a result of the weird way this class is
     # initialized, which we should fix, and then re-enable warning.
@@ -280,8 +809,9 @@ class File(object):
 
     def _init_from_cols(self, cols):
         (self.id, self.name, self.is_generated, self.is_override,
-         self.checked_runid, self.changed_runid, self.failed_runid,
-         self.stamp, self.csum) = cols
+         self.checked_runid, self.changed_runid, self.failed_runid) = cols[:7]
+        self.stamp = _stamp_from_cols(cols[7:19])
+        self.csum = cols[19]
         if self.name == ALWAYS and (
             self.changed_runid is None or self.changed_runid < env.v.RUNID):
             self.changed_runid = env.v.RUNID
@@ -304,9 +834,9 @@ class File(object):
                '    %s '
                '    where rowid=?' % cols,
                [self.is_generated, self.is_override,
-                self.checked_runid, self.changed_runid, self.failed_runid,
-                self.stamp, self.csum,
-                self.id])
+                self.checked_runid, self.changed_runid, self.failed_runid] +
+               _stamp_to_cols(self.stamp) +
+               [self.csum, self.id])
 
     def set_checked(self):
         self.checked_runid = env.v.RUNID
@@ -343,6 +873,9 @@ class File(object):
         self.failed_runid = None
         self.is_override = False
         self.is_generated = False
+        if env.v.HASH_SOURCES:
+            # so that same_content() can compare against it later.
+            content_hash(self.name, self.stamp)
 
     def set_override(self):
         self.update_stamp()
@@ -358,6 +891,16 @@ class File(object):
             self.stamp = newstamp
             self.set_changed()
 
+    def same_content(self, newstamp):
+        """Returns true if our content hasn't changed, despite newstamp.
+
+        That is, if the file with stamp newstamp has the same content hash
+        as it did when it had self.stamp.  If we don't know the old hash,
+        we have to assume it's different.
+        """
+        old = content_hash(self.name, self.stamp, compute=False)
+        return old is not None and content_hash(self.name, newstamp) == old
+
     def is_source(self):
         """Returns true if this object represents a source (not a target)."""
         if self.name.startswith('//'):
@@ -400,7 +943,8 @@ class File(object):
         q = ('select Deps.mode, Deps.source, %s '
              '  from Files '
              '    join Deps on Files.rowid = Deps.source '
-             '  where target=?' % ', '.join(_file_cols[1:]))
+             '  where target=?'
+             % ', '.join('Files.%s' % c for c in _file_cols[1:]))
         for row in db().execute(q, [self.id]).fetchall():
             mode = row[0]
             cols = row[1:]
@@ -408,14 +952,21 @@ class File(object):
             yield mode, File(cols=cols)
 
     def zap_deps1(self):
-        """Mark the list of dependencies of this object as deprecated.
+        """Start a new list of dependencies for this object.
 
         We do this when starting a new build of the current target.  We don't
-        delete them right away, because if the build fails, we still want to
-        know the old deps.
+        delete the old deps right away, because if the build fails, we still
+        want to know them.  Instead, add_deps() lists each dependency
+        declared during the build in depsname(), and zap_deps2() forgets
+        the ones that weren't.  That way, rebuilding a target whose
+        dependencies haven't changed doesn't write to the database at all.
         """
         debug2('zap-deps1: %r\n' % self.name)
-        _write('update Deps set delete_me=? where target=?', [True, self.id])
+        if _insane:
+            return
+        fd = os.open(depsname(self.id),
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.close(fd)
 
     def zap_deps2(self):
         """Delete any deps that were *not* referenced in the current run.
@@ -424,46 +975,65 @@ class File(object):
         We forget old dependencies only after a build completes successfully.
         """
         debug2('zap-deps2: %r\n' % self.name)
-        _write('delete from Deps where target=? and delete_me=1', [self.id])
+        if _insane:
+            return
+        fname = depsname(self.id)
+        try:
+            f = open(fname)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return  # zap_deps1() wasn't called; nothing to forget
+            raise
+        with f:
+            declared = set(int(line) for line in f if line.strip().isdigit())
+        unlink(fname)
+        q = 'select source from Deps where target=?'
+        gone = [[self.id, src]
+                for (src,) in db().execute(q, [self.id]).fetchall()
+                if src not in declared]
+        if gone:
+            _write_many('delete from Deps where target=? and source=?', gone)
 
     def add_dep(self, mode, dep):
-        src = File(name=dep)
-        debug3('add-dep: "%s" < %s "%s"\n' % (self.name, mode, src.name))
-        assert self.id != src.id
-        _write("insert or replace into Deps "
-               "    (target, mode, source, delete_me) values (?,?,?,?)",
-               [self.id, mode, src.id, False])
-
-    def _read_stamp_st(self, statfunc):
-        try:
-            st = statfunc(os.path.join(env.v.BASE, self.name))
-        except OSError:
-            return False, STAMP_MISSING
-        if stat.S_ISDIR(st.st_mode):
-            # directories change too much; detect only existence.
-            return False, STAMP_DIR
-        else:
-            # a "unique identifier" stamp for a regular file
-            return (
-                stat.S_ISLNK(st.st_mode),
-                '-'.join(str(s) for s in
-                         ('%.6f' % st.st_mtime, st.st_size, st.st_ino,
-                          st.st_mode, st.st_uid, st.st_gid))
-            )
+        self.add_deps(mode, [dep])
+
+    def add_deps(self, mode, deps):
+        """Record that this object depends on each of the named files.
+
+        This is like calling add_dep() for each one, but takes only a
+        few queries in total, rather than a few per dependency.  Deps we
+        already knew about aren't written again.
+        """
+        srcs = files_named(deps)
+        # List them before writing to the database, so that zap_deps2()
+        # can't forget one that we've just written.
+        _declare_deps(self.id, srcs)
+        # Only look up the edges we're adding, not all of our deps, or
+        # declaring them one at a time (eg. from a loop in a .do script)
+        # would take quadratic time.
+        q = ('select source, mode from Deps '
+             '  where target=? and source in (%s)')
+        ids = sorted(set(src.id for src in srcs))
+        old = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            old.update(db().execute(q % ','.join('?' * len(chunk)),
+                                    [self.id] + chunk).fetchall())
+        rows = []
+        for src in srcs:
+            debug3('add-dep: "%s" < %s "%s"\n' % (self.name, mode, src.name))
+            assert self.id != src.id
+            if old.get(src.id) != mode:
+                old[src.id] = mode
+                rows.append([self.id, mode, src.id, False])
+        if rows:
+            _write_many("insert or replace into Deps "
+                        "    (target, mode, source, delete_me) "
+                        "    values (?,?,?,?)",
+                        rows)
 
     def read_stamp(self):
-        is_link, pre = self._read_stamp_st(os.lstat)
-        if is_link:
-            # if we're a symlink, we actually care about the link object
-            # itself, *and* the target of the link.  If either changes,
-            # we're considered dirty.
-            #
-            # On the other hand, detect_override() doesn't care about the
-            # target of the link, only the link itself.
-            _, post = self._read_stamp_st(os.stat)
-            return pre + '+' + post
-        else:
-            return pre
+        return read_stamp(self.name)
 
     def nicename(self):
         return relpath(os.path.join(env.v.BASE, self.name), env.v.STARTDIR)
@@ -475,11 +1045,324 @@ def files():
         yield File(cols=cols)
 
 
+def dep_ids():
+    """Return a list of (target_id, source_id) for every dependency."""
+    return db().execute('select target, source from Deps').fetchall()
+
+
+def forget_files(fids):
+    """Remove the Files with the given ids, and all their dependencies.
+
+    Returns the number of dependencies removed.
+    """
+    ll = [[fid] for fid in fids]
+    count = (_write_many('delete from Deps where target=?', ll).rowcount +
+             _write_many('delete from Deps where source=?', ll).rowcount)
+    _write_many('delete from Stats where target=?', ll)
+    _write_many('delete from Files where rowid=?', ll)
+    return count
+
+
+def set_checked_many(fids):
+    """Like File.set_checked_save() for each of the given File ids."""
+    _write_many('update Files set checked_runid=? where rowid=?',
+                [[env.v.RUNID, fid] for fid in fids])
+
+
+def forget_dangling_deps():
+    """Remove dependencies on Files that don't exist; return how many."""
+    return _write('delete from Deps '
+                  '  where target not in (select rowid from Files) '
+                  '    or source not in (select rowid from Files)',
+                  []).rowcount
+
+
+def add_stats(fid, start, wall, utime, stime, maxrss, rv):
+    """Record how long it took to build File fid in this run, and so on.
+
+    Args:
+      fid: the File id of the target.
+      start: when the .do script started, in seconds since the epoch.
+      wall: how long it ran, in seconds.
+      utime, stime: the user and system CPU time it used, in seconds.
+      maxrss: the peak memory use of its biggest process, in kilobytes.
+      rv: its exit code.
+    The times include everything the .do script waited for, such as
+    building the targets it depends on.
+    """
+    _write('insert or replace into Stats '
+           '    (runid, target, start, wall, utime, stime, maxrss, rv) '
+           '    values (?,?,?,?,?,?,?,?)',
+           [env.v.RUNID, fid, start, wall, utime, stime, maxrss, rv])
+
+
+def stats_runids(limit):
+    """Return the ids of the latest runs that built anything, oldest first.
+
+    Returns at most limit of them.
+    """
+    rows = db().execute('select distinct runid from Stats '
+                        '  order by runid desc limit ?', [limit]).fetchall()
+    return [runid for (runid,) in reversed(rows)]
+
+
+def stats(runids):
+    """Return what add_stats() recorded in the given runs.
+
+    Returns:
+      A list of (runid, fid, name, start, wall, utime, stime, maxrss, rv).
+    """
+    if not runids:
+        return []
+    return db().execute(
+        'select runid, target, name, start, wall, utime, stime, maxrss, rv '
+        '  from Stats join Files on Files.id = Stats.target '
+        '  where runid in (%s) '
+        '  order by runid, start' % ','.join('?' * len(runids)),
+        runids).fetchall()
+
+
+def durations(names):
+    """Return how long each of the named targets took the last time.
+
+    Returns:
+      A dict of {name: seconds}, using the names as given, for the targets
+      that add_stats() has a record of.  The times include building the
+      targets each one depended on.
+    """
+    byrel = {}
+    for name in names:
+        byrel.setdefault(relpath(name, env.v.BASE), []).append(name)
+    todo = list(byrel)
+    # In sqlite, the other columns of a row chosen by max() come from
+    # that same row: so this is the wall time of each target's latest run.
+    q = ('select name, wall, max(runid) '
+         '  from Stats join Files on Files.id = Stats.target '
+         '  where name in (%s) '
+         '  group by target')
+    result = {}
+    for i in range(0, len(todo), 500):
+        chunk = todo[i:i+500]
+        for name, wall, _ in db().execute(q % ','.join('?' * len(chunk)),
+                                          chunk).fetchall():
+            for orig in byrel[name]:
+                result[orig] = wall
+    return result
+
+
+def compact_runids():
+    """Forget all the run ids except the latest; return how many.
+
+    Nothing refers to the rows in Runid.  We only need the latest one, so
+    that the next run can pick the id after it.
+    """
+    return _write('delete from Runid '
+                  '  where id < (select max(id) from Runid)', []).rowcount
+
+
+def vacuum():
+    """Give unused space in the database back to the filesystem.
+
+    Any pending changes are committed first.
+
+    Returns:
+      The total size, in bytes, of the database files (including the
+      write-ahead log) before and after.
+    """
+    dbfile = os.path.join(env.v.BASE, '.redo', 'db.sqlite3')
+    def size():
+        total = 0
+        for name in (dbfile, dbfile + '-wal'):
+            try:
+                total += os.stat(name).st_size
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return total
+    before = size()
+    commit()
+    d = db()
+    d.execute('pragma wal_checkpoint(TRUNCATE)')
+    d.execute('vacuum')
+    # vacuum writes the whole database out again, through the log.
+    d.execute('pragma wal_checkpoint(TRUNCATE)')
+    return before, size()
+
+
+# Recursive common table expressions ("with recursive") first appeared in
+# sqlite 3.8.3.  On anything older, we fall back to File.deps().
+_can_recurse = sqlite3.sqlite_version_info >= (3, 8, 3)
+
+
+def files_named(names, allow_add=True):
+    """Return a list of Files with the given names, in the same order.
+
+    This is like calling File(name=...) for each name, but looks them all
+    up at once, and adds all the missing ones at once.
+    """
+    names = [(name == ALWAYS) and ALWAYS or relpath(name, env.v.BASE)
+             for name in names]
+    q = ('select %s from Files where name in (%%s)' % ', '.join(_file_cols))
+    found = {}
+    def lookup(todo):
+        # Stay well below sqlite's default limit on the number of query
+        # parameters.
+        for i in range(0, len(todo), 500):
+            chunk = todo[i:i+500]
+            for cols in db().execute(q % ','.join('?' * len(chunk)),
+                                     chunk).fetchall():
+                found[cols[1]] = File(cols=cols)
+    uniq = []
+    seen = set()
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            uniq.append(name)
+    lookup(uniq)
+    missing = [name for name in uniq if name not in found]
+    if missing:
+        if not allow_add:
+            raise KeyError('No file with name=%r' % (missing[0],))
+        # "or ignore": some parallel redo might have added some of them
+        # at the same time; no big deal.
+        _write_many('insert or ignore into Files (name) values (?)',
+                    [[name] for name in missing])
+        lookup(missing)
+    return [found[name] for name in names]
+
+
+def deps_closure(roots, everything=False, unchecked=False):
+    """Load the transitive dependencies of the given Files all at once.
+
+    File.deps() costs one query per target, which adds up when walking a
+    big dependency graph (eg. in deps.isdirty()).  Instead, we fetch the
+    whole closure of 'm' dependencies, starting at roots, with a single
+    recursive query.  Like File.deps(), we only descend into targets that
+    are generated and not overridden.  'c' dependencies are included, but
+    not followed.
+
+    Args:
+      roots: a list of File objects to start from.
+      everything: if true, load the dependencies of every target in the
+        database, not just the ones reachable from roots.  This is
+        cheaper if you're going to look at all of them anyway.
+      unchecked: if true, don't descend into targets that have already
+        been checked in this run (see File.is_checked()).  deps.isdirty()
+        won't look below them, and when lots of targets share a big
+        subtree, loading it again for each one would be a waste.
+    Returns:
+      A dict of {target_id: [(mode, File), ...]}, or None if this version
+      of sqlite can't do recursive queries.  Each File object appears only
+      once, no matter how many targets depend on it, and the roots are
+      reused as-is.
+    """
+    if not _can_recurse and not everything:
+        return None
+    files = dict((f.id, f) for f in roots)
+    graph = {}
+    seen = set()
+    srccols = ', '.join('S.%s' % c for c in _file_cols)
+    if everything:
+        queries = [(
+            'select Deps.target, Deps.mode, %s '
+            '  from Deps '
+            '    join Files as T on T.rowid = Deps.target '
+            '    join Files as S on S.rowid = Deps.source '
+            '  where T.is_generated '
+            '    and not coalesce(T.is_override, 0)' % srccols, [])]
+    else:
+        # Stay well below sqlite's default limit on the number of query
+        # parameters.  Overlapping closures are merged by the files dict.
+        ids = list(files.keys())
+        if unchecked:
+            skip = ('and coalesce(Files.checked_runid, 0) < ? ',
+                    'and coalesce(T.checked_runid, 0) < ? ')
+            params = [env.v.RUNID]
+        else:
+            skip = ('', '')
+            params = []
+        queries = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            queries.append((
+                'with recursive Closure(id) as ( '
+                '    select rowid from Files where rowid in (%s) '
+                '  union '
+                '    select Deps.source from Closure '
+                '      join Files on Files.rowid = Closure.id '
+                '      join Deps on Deps.target = Closure.id '
+                '    where Deps.mode = \'m\' '
+                '      and Files.is_generated '
+                '      and not coalesce(Files.is_override, 0) '
+                '      %s'
+                ') '
+                'select Deps.target, Deps.mode, %s '
+                '  from Closure '
+                '    join Files as T on T.rowid = Closure.id '
+                '    join Deps on Deps.target = Closure.id '
+                '    join Files as S on S.rowid = Deps.source '
+                '  where T.is_generated '
+                '    and not coalesce(T.is_override, 0) '
+                '    %s'
+                % (', '.join('?' * len(chunk)), skip[0], srccols, skip[1]),
+                chunk + params + params))
+    for q, l in queries:
+        for row in db().execute(q, l).fetchall():
+            target, mode, cols = row[0], row[1], row[2:]
+            assert mode in ('c', 'm')
+            if (target, cols[0]) in seen:
+                continue
+            seen.add((target, cols[0]))
+            src = files.get(cols[0])
+            if not src:
+                src = files[cols[0]] = File(cols=cols)
+            graph.setdefault(target, []).append((mode, src))
+    return graph
+
+
 def logname(fid):
     """Given the id of a File, return the filename of its build log."""
     return os.path.join(env.v.BASE, '.redo', 'log.%d' % fid)
 
 
+def depsname(fid):
+    """Given the id of a File, return the filename listing its new deps.
+
+    While the File is being built, this lists the ids of the dependencies
+    it has declared so far, one per line.
+    """
+    return os.path.join(env.v.BASE, '.redo', 'deps.%d' % fid)
+
+
+def jobsdir(fid):
+    """Given the id of a File, return the dir for its background jobs.
+
+    While the File is being built, its .do script can start building
+    targets in the background with redo-ifchange --start.  Each one has
+    a file in here, which it keeps locked until it's done, and then
+    leaves its exit code in.  redo-wait waits for them.
+    """
+    return os.path.join(env.v.BASE, '.redo', 'jobs.%d' % fid)
+
+
+def _declare_deps(fid, srcs):
+    """Add srcs to depsname(fid), if the File fid is being built."""
+    if _insane:
+        return
+    try:
+        fd = os.open(depsname(fid), os.O_WRONLY | os.O_APPEND)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return  # not being built right now
+        raise
+    try:
+        # A single write() with O_APPEND, so that parallel redo-ifchange
+        # calls for the same target can't mix up each other's lines.
+        os.write(fd, ''.join('%d\n' % src.id for src in srcs).encode('ascii'))
+    finally:
+        os.close(fd)
+
+
 # FIXME: I really want to use fcntl F_SETLK, F_SETLKW, etc here.  But python
 # doesn't do the lockdata structure in a portable way, so we have to use
 # fcntl.lockf() instead.  Usually this is just a wrapper for fcntl, so it's
@@ -0,0 +1,446 @@
+"""Rebuild targets whenever their sources change (redo --watch)."""
+import errno, marshal, os, select, signal, struct, sys, time
+from . import env, helpers, state
+from .paths import possible_do_files
+
+# After the first change, wait until nothing else has changed for this
+# long, so that saving a bunch of files at once only causes one rebuild.
+DEBOUNCE = 0.1
+
+# How often to check the sources, if we can't use inotify.
+POLL_INTERVAL = 0.5
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ONLYDIR = 0x1000000
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+_fsencode = getattr(os, 'fsencode', lambda s: s)
+_fsdecode = getattr(os, 'fsdecode', lambda s: s)
+
+_report_fd = None
+_changed = None
+
+
+class _Inotify(object):
+    """Find out about changes to files from the kernel, without polling."""
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.dirs = {}  # dir -> watch descriptor
+        self.wds = {}   # watch descriptor -> dir
+        self.paths = set()
+        self.parents = set()
+
+    @classmethod
+    def create(cls):
+        """Return a new _Inotify, or None if this OS doesn't have inotify."""
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            init = libc.inotify_init1
+        except (ImportError, OSError, AttributeError):
+            return None
+        fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, paths):
+        """Start reporting changes to any of the given paths.
+
+        We watch the directory containing each path, rather than the path
+        itself, so that we notice when a file is created, or replaced by
+        renaming a new one over it.  If the directory doesn't exist yet, we
+        watch the nearest one that does, and notice when the rest appears.
+        """
+        self.paths = set(paths)
+        self.parents = set()
+        for path in self.paths:
+            d = os.path.dirname(path)
+            while d not in self.parents:
+                self.parents.add(d)
+                if d in self.dirs:
+                    break
+                wd = self.libc.inotify_add_watch(self.fd, _fsencode(d),
+                                                 _WATCH_MASK)
+                if wd >= 0:
+                    self.dirs[d] = wd
+                    self.wds[wd] = d
+                    break
+                parent = os.path.dirname(d)
+                if parent == d:
+                    break
+                d = parent
+        # Stop watching directories that nothing we care about is in
+        # anymore.  We'll ignore the IN_IGNORED event for them.
+        for d in set(self.dirs) - self.parents:
+            wd = self.dirs.pop(d)
+            del self.wds[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _read(self):
+        """Return the changed paths we care about, or None if we lost track.
+
+        If the kernel's queue overflowed, we don't know what changed, so
+        we have to assume that everything did.
+        """
+        changed = set()
+        while 1:
+            try:
+                b = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return changed
+                raise
+            ofs = 0
+            while ofs < len(b):
+                wd, mask, _, namelen = struct.unpack_from('iIII', b, ofs)
+                ofs += 16
+                name = _fsdecode(b[ofs:ofs+namelen].rstrip(b'\0'))
+                ofs += namelen
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                d = self.wds.get(wd)
+                if mask & IN_IGNORED:
+                    # The directory is gone; we'll watch it again in
+                    # watch(), if it comes back.
+                    if d is not None:
+                        del self.wds[wd]
+                        del self.dirs[d]
+                    continue
+                if d is None or not name:
+                    continue
+                path = os.path.join(d, name)
+                if path in self.paths or path in self.parents:
+                    changed.add(path)
+
+    def wait(self):
+        """Wait for some of our paths to change, and return which ones."""
+        changed = set()
+        timeout = None
+        while 1:
+            try:
+                r, _, _ = select.select([self.fd], [], [], timeout)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not r:
+                return changed
+            got = self._read()
+            if got is None:
+                return None
+            changed |= got
+            if changed:
+                timeout = DEBOUNCE
+
+
+class _Poller(object):
+    """Find out about changes to files by checking them every so often."""
+    def __init__(self):
+        self.stamps = {}
+
+    def close(self):
+        pass
+
+    def watch(self, paths):
+        """Start reporting changes to any of the given paths."""
+        stamps = {}
+        for path in paths:
+            stamps[path] = self.stamps.get(path) or _stamp(path)
+        self.stamps = stamps
+
+    def _changed(self):
+        return set(path for path, stamp in self.stamps.items()
+                   if _stamp(path) != stamp)
+
+    def wait(self):
+        """Wait for some of our paths to change, and return which ones."""
+        while 1:
+            changed = self._changed()
+            if changed:
+                while 1:
+                    time.sleep(DEBOUNCE)
+                    more = self._changed()
+                    if more <= changed:
+                        break
+                    changed |= more
+                for path in changed:
+                    self.stamps[path] = _stamp(path)
+                return changed
+            time.sleep(POLL_INTERVAL)
+
+
+def _stamp(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return (None,)
+    return (st.st_mtime, st.st_size, st.st_ino, st.st_mode)
+
+
+def _build(targets, changed):
+    """Fork a child to build targets; return (exit code, reported sources).
+
+    changed is the set of paths that changed since the last build, or None
+    if we don't know.  In the child, this returns (None, None).
+    """
+    r, w = os.pipe()
+    helpers.close_on_exec(r, True)
+    helpers.close_on_exec(w, True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        global _report_fd, _changed
+        os.close(r)
+        _report_fd = w
+        _changed = changed
+        return None, None
+    os.close(w)
+    # Let the build decide what to do about Ctrl-C; we'll follow its lead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        chunks = []
+        while 1:
+            b = os.read(r, 65536)
+            if not b:
+                break
+            chunks.append(b)
+        while 1:
+            try:
+                _, status = os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+    finally:
+        os.close(r)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    if os.WIFSIGNALED(status):
+        rv = 128 + os.WTERMSIG(status)
+    else:
+        rv = os.WEXITSTATUS(status)
+    sources = {}
+    if chunks:
+        sources = marshal.loads(b''.join(chunks))
+    return rv, sources
+
+
+def start(targets):
+    """Build targets, then build them again whenever their sources change.
+
+    Each build runs in a new child process, which is a normal toplevel
+    redo in every way, and this function returns in that child with
+    (targets, first): the list of targets it should build, and whether
+    this is the first build.  When it's done, the child calls report(), so
+    that we know which files each target depends on.  In the original
+    process, this function never returns.
+
+    After the first build, only the targets whose sources changed are
+    built again, and only if redo-ifchange would build them, so that
+    whatever didn't change below them isn't rebuilt.  The child calls
+    skip_unchanged() so that redo-ifchange only checks what the changed
+    sources could have affected.
+    """
+    watcher = _Inotify.create() or _Poller()
+    sources = {}  # target -> list of source paths
+    watched = set()
+    todo = list(targets)
+    changed = None
+    first = True
+    while 1:
+        # File timestamps come from a clock that can lag a little behind
+        # time.time(), so leave some room.
+        started = time.time() - 0.05
+        rv, got = _build(todo, changed)
+        if rv is None:
+            watcher.close()
+            return todo, first
+        first = False
+        if rv == 200:
+            raise KeyboardInterrupt()
+        sources.update(got)
+        paths = set()
+        for t in targets:
+            paths.update(sources.get(t, []))
+        watcher.watch(paths)
+        # We couldn't watch the files we just found out about while the
+        # build was running, so check whether they changed in the meantime.
+        changed = set(p for p in paths - watched
+                      if _modified_since(p, started))
+        watched = paths
+        todo = _affected(targets, sources, changed)
+        if not todo:
+            sys.stderr.write('redo: watching %d file%s for changes; '
+                             'press Ctrl-C to stop.\n'
+                             % (len(paths), len(paths) != 1 and 's' or ''))
+        while not todo:
+            changed = watcher.wait()
+            if changed and changed - paths:
+                # Some directories we were waiting for appeared, so watch
+                # what's in them too.  Files may have been created in them
+                # before we could, so look for those ourselves.
+                appeared = changed - paths
+                watcher.watch(paths)
+                changed |= set(p for p in paths
+                               if _inside(p, appeared) and os.path.lexists(p))
+            todo = _affected(targets, sources, changed)
+
+
+def _modified_since(path, t):
+    try:
+        return os.lstat(path).st_mtime >= t
+    except OSError:
+        return False
+
+
+def _inside(path, dirs):
+    """Return true if path is somewhere inside any of dirs."""
+    d = os.path.dirname(path)
+    while d not in dirs:
+        up = os.path.dirname(d)
+        if up == d:
+            return False
+        d = up
+    return True
+
+
+def _affected(targets, sources, changed):
+    """Return the targets that need to be rebuilt because of changed.
+
+    If changed is None, we don't know what changed, so that's all of them.
+    """
+    if changed is None:
+        return list(targets)
+    if not changed:
+        return []
+    return [t for t in targets
+            if t not in sources or changed & set(sources[t])]
+
+
+def _graph(fs):
+    """Return the dependency graph below fs, from state.deps_closure()."""
+    graph = state.deps_closure(fs)
+    if graph is None:
+        graph = state.deps_closure(fs, everything=True)
+    return graph
+
+
+def _do_files(f):
+    """Return the paths of the .do files that could build f.
+
+    That's the ones that don't exist, up to the first one that does.
+    """
+    got = set()
+    for dodir, dofile, _, _, _ in possible_do_files(f.name):
+        path = os.path.join(dodir, dofile)
+        got.add(path)
+        if os.path.exists(path):
+            break
+    return got
+
+
+def skip_unchanged(targets):
+    """Mark everything below targets that didn't change as checked.
+
+    In a build started by start(), we know which sources changed since the
+    last build, so nothing else below targets can be dirty, unless it was
+    dirty then too.  deps.isdirty() then only has to look at the changed
+    sources and what depends on them, instead of all of them.  Targets
+    that failed or were never built are still dirty, since isdirty()
+    looks for that before asking whether they were checked.
+    """
+    if _changed is None:
+        return
+    fs = [state.File(name=t) for t in targets]
+    graph = _graph(fs)
+    # Find everything below targets, and who depends on each of them.
+    files = {}
+    users = {}
+    todo = list(fs)
+    while todo:
+        f = todo.pop()
+        if f.id in files:
+            continue
+        files[f.id] = f
+        for _, dep in graph.get(f.id, []):
+            users.setdefault(dep.id, []).append(f)
+            todo.append(dep)
+    # Then everything that depends on a changed file, however indirectly.
+    # Things that depend on redo-always are always dirty.
+    todo = [f for f in files.values()
+            if f.name == state.ALWAYS or
+            os.path.join(env.v.BASE, f.name) in _changed]
+    affected = set()
+    while todo:
+        f = todo.pop()
+        if f.id in affected:
+            continue
+        affected.add(f.id)
+        todo.extend(users.get(f.id, []))
+    # We don't know everything about targets (see report()), so always
+    # check them properly.
+    affected.update(f.id for f in fs)
+    state.set_checked_many(fid for fid in files if fid not in affected)
+    state.commit()
+
+
+def _sources(f, graph):
+    """Return the paths of the files that f depends on and nobody builds."""
+    paths = set()
+    seen = set()
+    todo = [f]
+    while todo:
+        f = todo.pop()
+        if f.id in seen or f.name == state.ALWAYS:
+            continue
+        seen.add(f.id)
+        if f.id in graph:
+            todo.extend(dep for _, dep in graph[f.id])
+        elif f.is_override or not f.is_generated:
+            paths.add(os.path.join(env.v.BASE, f.name))
+    return paths
+
+
+def report(targets):
+    """If this build was started by start(), tell it what to watch.
+
+    We don't need to look for changes ourselves: the database already
+    knows which sources each target used the last time it was built.
+    If it doesn't know anything about a target, eg. because its .do file
+    doesn't exist yet, we watch the .do files that could build it.
+    """
+    global _report_fd
+    if _report_fd is None:
+        return
+    fs = [state.File(name=t) for t in targets]
+    graph = _graph(fs)
+    sources = {}
+    for t, f in zip(targets, fs):
+        got = _sources(f, graph)
+        if f.id not in graph:
+            got |= _do_files(f)
+        sources[t] = sorted(got)
+    data = marshal.dumps(sources)
+    try:
+        while data:
+            data = data[os.write(_report_fd, data):]
+    finally:
+        os.close(_report_fd)
+        _report_fd = None
@@ -43,17 +43,20 @@ setuptools.setup(
     ],
     entry_points = {
         'console_scripts': [
-            'redo=redo.cmd_redo:main',
-            'redo-always=redo.cmd_always:main',
-            'redo-ifchange=redo.cmd_ifchange:main',
-            'redo-ifcreate=redo.cmd_ifcreate:main',
-            'redo-log=redo.cmd_log:main',
-            'redo-ood=redo.cmd_ood:main',
-            'redo-sources=redo.cmd_sources:main',
-            'redo-stamp=redo.cmd_stamp:main',
-            'redo-targets=redo.cmd_targets:main',
-            'redo-unlocked=redo.cmd_unlocked:main',
-            'redo-whichdo=redo.cmd_whichdo:main',
+            'redo=redo.entry:redo',
+            'redo-always=redo.entry:always',
+            'redo-gc=redo.entry:gc',
+            'redo-ifchange=redo.entry:ifchange',
+            'redo-ifcreate=redo.entry:ifcreate',
+            'redo-log=redo.entry:log',
+            'redo-ood=redo.entry:ood',
+            'redo-sources=redo.entry:sources',
+            'redo-stamp=redo.entry:stamp',
+            'redo-stats=redo.entry:stats',
+            'redo-targets=redo.entry:targets',
+            'redo-unlocked=redo.entry:unlocked',
+            'redo-wait=redo.entry:wait',
+            'redo-whichdo=redo.entry:whichdo',
         ],
     },
 )
@@ -0,0 +1,21 @@
+-- A redo v2 database for the project in proj/, in sqlite3 format.
+-- Keep the ids in Files as they were: Deps and the logs refer to them.
+CREATE TABLE Schema     (version int);
+insert into Schema (rowid, version) values (1, 2);
+CREATE TABLE Runid     (id integer primary key autoincrement);
+insert into Runid (id) values (1000000000);
+insert into Runid (id) values (1000000001);
+CREATE TABLE Files     (name not null primary key,      is_generated int,      is_override int,      checked_runid int,      changed_runid int,      failed_runid int,      stamp,      csum);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (1, '//ALWAYS', NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (2, 'all', 1, 0, NULL, 1000000001, NULL, '0', NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (3, 'all.do', 0, 0, NULL, 1000000001, NULL, '1792347262.050076-24-13607221-33188-0-0', NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (4, 'hello.out', 1, 0, NULL, 1000000001, NULL, '1792347264.465904-6-13608019-33188-0-0', NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (5, 'hello.out.do', 0, 0, NULL, 1000000001, NULL, '1792347262.050146-166-13607308-33188-0-0', NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (6, 'hello.local', NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, stamp, csum) values (7, 'hello.in', 0, 0, NULL, 1000000001, NULL, '1792347262.050178-6-13607320-33188-0-0', NULL);
+CREATE TABLE Deps     (target int,      source int,      mode not null,      delete_me int,      primary key (target,source));
+insert into Deps (rowid, target, source, mode, delete_me) values (1, 2, 3, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (2, 2, 4, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (3, 4, 5, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (4, 4, 6, 'c', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (5, 4, 7, 'm', 0);
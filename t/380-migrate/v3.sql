@@ -0,0 +1,21 @@
+-- A redo v3 database for the project in proj/, in sqlite3 format.
+-- Keep the ids in Files as they were: Deps and the logs refer to them.
+CREATE TABLE Schema     (version int);
+insert into Schema (rowid, version) values (1, 3);
+CREATE TABLE Runid     (id integer primary key autoincrement);
+insert into Runid (id) values (1000000000);
+insert into Runid (id) values (1000000001);
+CREATE TABLE Files     (name not null primary key,      is_generated int,      is_override int,      checked_runid int,      changed_runid int,      failed_runid int,      mtime_ns int, size int, ino int, mode int, uid int, gid int, link_mtime_ns int, link_size int, link_ino int, link_mode int, link_uid int, link_gid int,      csum);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (1, '//ALWAYS', NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (2, 'all', 1, 0, NULL, 1000000001, NULL, 0, 0, 0, 0, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (3, 'all.do', 0, 0, NULL, 1000000001, NULL, 1792347262054978441, 24, 13607354, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (4, 'hello.out', 1, 0, NULL, 1000000001, NULL, 1792347267336205414, 6, 13608037, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (5, 'hello.out.do', 0, 0, NULL, 1000000001, NULL, 1792347262060205100, 166, 13607388, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (6, 'hello.local', NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (rowid, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (7, 'hello.in', 0, 0, NULL, 1000000001, NULL, 1792347262063659512, 6, 13607697, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+CREATE TABLE Deps     (target int,      source int,      mode not null,      delete_me int,      primary key (target,source));
+insert into Deps (rowid, target, source, mode, delete_me) values (1, 2, 3, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (2, 2, 4, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (3, 4, 5, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (4, 4, 6, 'c', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (5, 4, 7, 'm', 0);
@@ -0,0 +1,28 @@
+-- A redo v6 database for the project in proj/, in sqlite3 format.
+-- Keep the ids in Files as they were: Deps and the logs refer to them.
+CREATE TABLE Schema     (version int);
+insert into Schema (rowid, version) values (1, 6);
+CREATE TABLE Runid     (id integer primary key autoincrement);
+insert into Runid (id) values (1000000000);
+insert into Runid (id) values (1000000001);
+CREATE TABLE Files     (id integer primary key,      name not null unique,      is_generated int,      is_override int,      checked_runid int,      changed_runid int,      failed_runid int,      mtime_ns int, size int, ino int, mode int, uid int, gid int, link_mtime_ns int, link_size int, link_ino int, link_mode int, link_uid int, link_gid int,      csum);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (1, '//ALWAYS', NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (2, 'all', 1, 0, NULL, 1000000001, NULL, 0, 0, 0, 0, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (3, 'all.do', 0, 0, NULL, 1000000001, NULL, 1792348846370550960, 24, 13624163, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (4, 'hello.out', 1, 0, NULL, 1000000001, NULL, 1792348848232299387, 6, 13624466, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (5, 'hello.out.do', 0, 0, NULL, 1000000001, NULL, 1792348846370638675, 166, 13624294, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (6, 'hello.local', NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+insert into Files (id, name, is_generated, is_override, checked_runid, changed_runid, failed_runid, mtime_ns, size, ino, mode, uid, gid, link_mtime_ns, link_size, link_ino, link_mode, link_uid, link_gid, csum) values (7, 'hello.in', 0, 0, NULL, 1000000001, NULL, 1792348846370699021, 6, 13624311, 33188, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL);
+CREATE TABLE Deps     (target int,      source int,      mode not null,      delete_me int,      primary key (target,source));
+insert into Deps (rowid, target, source, mode, delete_me) values (1, 2, 3, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (2, 2, 4, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (3, 4, 5, 'm', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (4, 4, 6, 'c', 0);
+insert into Deps (rowid, target, source, mode, delete_me) values (5, 4, 7, 'm', 0);
+CREATE TABLE Hashes     (mtime_ns int,      size int,      ino int,      hash not null,      primary key (mtime_ns, size, ino));
+insert into Hashes (rowid, mtime_ns, size, ino, hash) values (1, 1792348846370550960, 24, 13624163, 'bc6fdf7a8eff8b2451491d3ca292e1b1912fde2e');
+insert into Hashes (rowid, mtime_ns, size, ino, hash) values (2, 1792348846370638675, 166, 13624294, 'a5184f7044537e45581de5ceb6f65c0917e74400');
+insert into Hashes (rowid, mtime_ns, size, ino, hash) values (3, 1792348846370699021, 6, 13624311, 'f572d396fae9206628714fb2ce00f72e94f2258f');
+CREATE TABLE Stats     (runid int,      target int,      start real,      wall real,      utime real,      stime real,      maxrss int,      rv int,      primary key (runid, target));
+insert into Stats (rowid, runid, target, start, wall, utime, stime, maxrss, rv) values (1, 1000000001, 4, 1792348847.4753628, 0.7669069766998291, 0.29027, 0.074131, 20244, 0);
+insert into Stats (rowid, runid, target, start, wall, utime, stime, maxrss, rv) values (2, 1000000001, 2, 1792348847.0697496, 1.2026607990264893, 0.45295199999999997, 0.114548, 20564, 0);
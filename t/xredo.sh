@@ -0,0 +1,21 @@
+# Run a command as if from the command line, in a project of its own
+# with its own .redo directory, rather than as part of the current build.
+#
+# xredo_in DIR COMMAND...: run COMMAND in the project at DIR.
+# xredo COMMAND...: the same, in the project at work.
+xredo_in() {
+	(
+		cd "$1"
+		shift
+		for v in $(env | sed -n 's/^\(REDO[A-Z_]*\)=.*/\1/p'); do
+			unset "$v"
+		done
+		REDO_BASE=$PWD REDO_STARTDIR=$PWD
+		export REDO_BASE REDO_STARTDIR
+		exec "$@"
+	)
+}
+
+xredo() {
+	xredo_in work "$@"
+}